@@ -1,17 +1,63 @@
-from flask import Flask, render_template, jsonify
+from flask import Flask, render_template, jsonify, g, Response, before_render_template, template_rendered
 import requests
 import time
 import os
 import json
 from datetime import datetime
-from config import API_URL, AUTH_KEY, AUTH_URL, DOMAIN
+from config import (
+    API_URL, AUTH_KEY, AUTH_URL, TRUNKS_URL, CACHE_SETTLE_SECONDS,
+    HTTP_POOL_SIZE, API_CONNECT_TIMEOUT, API_TIMEOUT_AUTH, API_TIMEOUT_SEARCH, API_TIMEOUT_TRUNKS,
+    INGEST_ENABLED, INGEST_INTERVAL, INGEST_STALE_SECONDS, API_MAX_RESULTS, SINGLE_FLIGHT_TIMEOUT,
+    DB_BUSY_TIMEOUT, DB_MMAP_SIZE, DB_CACHE_SIZE_KB, LIVE_POLL_INTERVAL, LIVE_STREAM_SECONDS,
+    LIVE_MAX_STREAMS, DB_DIAGNOSTICS
+)
 import logging
 import sqlite3
 import hashlib
+import threading
+import codecs
+import csv
+import io
+import zlib
+import itertools
+from array import array
+from contextlib import contextmanager
+from collections import OrderedDict
 
 KEY_FILE = 'pbx_api_key.json'
 DB_FILE = 'calls_history.db'
 
+# Колонки calls, которые нужны страницам и статистике (без JSON-blob call_data)
+CALL_COLUMNS = ('id', 'start_stamp', 'end_stamp', 'caller_id_number', 'destination_number',
+                'billsec', 'duration', 'accountcode', 'description')
+
+# Сколько звонков записывать в БД одной транзакцией (одним executemany) при потоковой загрузке
+SAVE_BATCH_SIZE = 5000
+
+# Звонок длиннее этого числа секунд считается результативным (колонка '>45с')
+LONG_CALL_SECONDS = 45
+
+# Минимальная длина куска периода, который ещё имеет смысл делить при обрезанном ответе
+MIN_SPLIT_SECONDS = 60
+
+# Сколько звонков отдаёт /api/calls за одну страницу по умолчанию и максимум
+CALLS_PAGE_SIZE = 100
+CALLS_PAGE_MAX_SIZE = 1000
+
+# Сколько строк читать из БД за один fetchmany при потоковой выгрузке
+EXPORT_FETCH_SIZE = 1000
+
+# Сколько отрендеренных страниц закрытых дней держать в памяти воркера
+DAY_RESPONSE_CACHE_SIZE = 64
+
+# Cache-Control для страниц закрытых дней: по абсолютной дате и по относительному адресу (вчера, позавчера)
+CLOSED_DAY_CACHE_CONTROL = 'public, max-age=86400'
+RELATIVE_DAY_CACHE_CONTROL = 'no-cache'
+
+# Сколько дат (колонок) отдаёт /api/stats/matrix за один запрос по умолчанию и максимум
+STATS_MATRIX_COLUMNS = 14
+STATS_MATRIX_MAX_COLUMNS = 366
+
 def format_timestamp(timestamp):
     """Преобразует Unix timestamp в формат ЧЧ:ММ:СС ДД.ММ.ГГ"""
     try:
@@ -45,6 +91,150 @@ logging.basicConfig(
     ]
 )
 
+# Метрики в формате Prometheus. Хранятся в памяти каждого воркера отдельно
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_HELP = {
+    'pbx_upstream_request_seconds': ('histogram', 'Upstream API request latency until response headers'),
+    'pbx_stage_seconds': ('histogram', 'Time spent in internal processing stages'),
+    'pbx_cache_lookups_total': ('counter', 'Period cache lookups by result'),
+    'pbx_api_key_refresh_total': ('counter', 'API key refresh attempts by result'),
+    'pbx_http_pool_requests_total': ('counter', 'Requests sent through the upstream connection pool'),
+    'pbx_http_pool_connections_total': ('counter', 'New connections opened by the upstream connection pool'),
+    'pbx_day_response_cache_total': ('counter', 'Closed-day page requests by cache result'),
+    'pbx_live_streams_total': ('counter', 'Live feed stream requests by result (opened or rejected)'),
+}
+_metrics_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+def observe(name, value, **labels):
+    """Добавляет наблюдение в гистограмму"""
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': [0] * len(METRIC_BUCKETS), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+def inc_counter(name, amount=1, **labels):
+    """Увеличивает счётчик"""
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+@contextmanager
+def timed(stage):
+    """Замеряет длительность блока в гистограмме pbx_stage_seconds"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('pbx_stage_seconds', time.perf_counter() - started, stage=stage)
+
+def format_metric_labels(labels):
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}' if labels else ''
+
+def render_metrics():
+    """Текстовое представление метрик для Prometheus"""
+    http_stats = get_http_stats()
+    lines = []
+    with _metrics_lock:
+        histograms = {key: dict(value, buckets=list(value['buckets'])) for key, value in _histograms.items()}
+        counters = dict(_counters)
+    counters[('pbx_http_pool_requests_total', ())] = http_stats['requests']
+    counters[('pbx_http_pool_connections_total', ())] = http_stats['connections']
+    
+    for name, (metric_type, help_text) in METRIC_HELP.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        if metric_type == 'histogram':
+            for (metric_name, labels), histogram in sorted(histograms.items()):
+                if metric_name != name:
+                    continue
+                for bound, count in zip(METRIC_BUCKETS, histogram['buckets']):
+                    lines.append(f'{name}_bucket{format_metric_labels(labels + (("le", bound),))} {count}')
+                lines.append(f'{name}_bucket{format_metric_labels(labels + (("le", "+Inf"),))} {histogram["count"]}')
+                lines.append(f'{name}_sum{format_metric_labels(labels)} {histogram["sum"]:.6f}')
+                lines.append(f'{name}_count{format_metric_labels(labels)} {histogram["count"]}')
+        else:
+            for (metric_name, labels), value in sorted(counters.items()):
+                if metric_name == name:
+                    lines.append(f'{name}{format_metric_labels(labels)} {value}')
+    
+    return '\n'.join(lines) + '\n'
+
+# Таймауты (подключение, чтение) по эндпоинтам API
+API_TIMEOUTS = {
+    'auth': (API_CONNECT_TIMEOUT, API_TIMEOUT_AUTH),
+    'search': (API_CONNECT_TIMEOUT, API_TIMEOUT_SEARCH),
+    'trunks': (API_CONNECT_TIMEOUT, API_TIMEOUT_TRUNKS),
+}
+
+_http_session = None
+_http_session_pid = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Общая для процесса HTTP-сессия с пулом keep-alive соединений к API"""
+    global _http_session, _http_session_pid
+    with _http_session_lock:
+        # После fork (preload_app) соединения родителя использовать нельзя
+        if _http_session is None or _http_session_pid != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({
+                'Accept-Encoding': 'gzip, deflate',
+                'Connection': 'keep-alive'
+            })
+            _http_session = session
+            _http_session_pid = os.getpid()
+            logging.info(f'Created HTTP session with pool size {HTTP_POOL_SIZE}')
+        return _http_session
+
+def pbx_post(endpoint, url, **kwargs):
+    """POST-запрос к API через общую сессию с таймаутом эндпоинта ('auth', 'search', 'trunks')"""
+    kwargs.setdefault('timeout', API_TIMEOUTS[endpoint])
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        response = get_http_session().post(url, **kwargs)
+        status = str(response.status_code)
+        return response
+    except requests.exceptions.Timeout:
+        status = 'timeout'
+        raise
+    finally:
+        observe('pbx_upstream_request_seconds', time.perf_counter() - started, endpoint=endpoint, status=status)
+
+def get_http_stats():
+    """Статистика переиспользования соединений пула текущего процесса"""
+    stats = {'pid': os.getpid(), 'pools': [], 'requests': 0, 'connections': 0}
+    if _http_session is None or _http_session_pid != os.getpid():
+        return stats
+    
+    pools = _http_session.get_adapter('https://').poolmanager.pools
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        stats['pools'].append({
+            'host': f"{pool.scheme}://{pool.host}:{pool.port}",
+            'requests': pool.num_requests,
+            'connections': pool.num_connections
+        })
+        stats['requests'] += pool.num_requests
+        stats['connections'] += pool.num_connections
+    
+    stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+    stats['reuse_ratio'] = round(stats['reused'] / stats['requests'], 3) if stats['requests'] else 0.0
+    return stats
+
 def load_api_key():
     try:
         if os.path.exists(KEY_FILE):
@@ -60,8 +250,11 @@ def load_api_key():
 def save_api_key(key_id, key):
     api_key = f"{key_id}:{key}"
     try:
-        with open(KEY_FILE, 'w') as f:
+        # Пишем атомарно, чтобы другие воркеры не прочитали файл наполовину
+        tmp_file = f'{KEY_FILE}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
             json.dump({'api_key': api_key}, f)
+        os.replace(tmp_file, KEY_FILE)
         logging.info('API key saved to file.')
     except Exception as e:
         logging.error(f'Error saving API key to file: {e}')
@@ -70,75 +263,134 @@ def save_api_key(key_id, key):
 def get_new_api_key():
     payload = {'auth_key': AUTH_KEY, 'new': 'true'}
     try:
-        resp = requests.post(AUTH_URL, data=payload, timeout=10)
+        resp = pbx_post('auth', AUTH_URL, data=payload)
         resp.raise_for_status()
         data = resp.json()
         if data.get('status') == '1':
             key_id = data['data']['key_id']
             key = data['data']['key']
             logging.info('New API key obtained successfully.')
+            inc_counter('pbx_api_key_refresh_total', result='success')
             return save_api_key(key_id, key)
         else:
             logging.error(f"Auth error: {data}")
             raise Exception(f"Auth error: {data}")
     except Exception as e:
         logging.error(f"Error getting new API key: {e}")
+        inc_counter('pbx_api_key_refresh_total', result='error')
+        return None
+
+# Ключ в памяти процесса и mtime файла, из которого он прочитан
+_api_key_cache = {'key': None, 'mtime': None}
+_api_key_lock = threading.Lock()
+
+def get_key_file_mtime():
+    try:
+        return os.stat(KEY_FILE).st_mtime_ns
+    except OSError:
         return None
 
+def reload_api_key():
+    """Перечитывает ключ из файла в память процесса"""
+    mtime = get_key_file_mtime()
+    _api_key_cache['key'] = load_api_key() if mtime is not None else None
+    _api_key_cache['mtime'] = mtime
+    return _api_key_cache['key']
+
 def get_valid_api_key():
-    api_key = load_api_key()
+    """Возвращает ключ из памяти; файл перечитывается, только если его обновил другой воркер"""
+    mtime = get_key_file_mtime()
+    if _api_key_cache['key'] and mtime == _api_key_cache['mtime']:
+        return _api_key_cache['key']
+    
+    api_key = reload_api_key()
     if not api_key:
         logging.info('No valid API key found, requesting new one.')
-        api_key = get_new_api_key()
+        api_key = refresh_api_key()
     return api_key
 
-def init_db():
-    """Инициализация базы данных SQLite"""
-    import os
-    logging.info(f"=== DATABASE INITIALIZATION DEBUG ===")
+def refresh_api_key(rejected_key=None):
+    """Получает новый ключ взамен отвергнутого API. Обновляет ключ только один процесс;
+    если ключ уже сменил другой поток или воркер, просто возвращает новый"""
+    with _api_key_lock:
+        current_key = reload_api_key()
+        if current_key and current_key != rejected_key:
+            logging.info('API key was already refreshed by another worker.')
+            return current_key
+        
+        try:
+            run_with_lease('api_key_refresh', get_new_api_key)
+        except TimeoutError as e:
+            logging.error(str(e))
+        
+        current_key = reload_api_key()
+        if current_key == rejected_key:
+            return None
+        return current_key
+
+_db_local = threading.local()
+
+def get_db():
+    """Соединение с БД текущего потока: открывается один раз и переиспользуется.
+    После fork воркер открывает своё соединение, родительское не трогаем"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None or _db_local.pid != os.getpid():
+        conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}')
+        conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+        conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        _db_local.conn = conn
+        _db_local.pid = os.getpid()
+    return conn
+
+# Пересчёт почасовых агрегатов по сырым звонкам за диапазон [?, ?)
+HOURLY_ROLLUP_SQL = '''
+    INSERT OR REPLACE INTO hourly_caller_stats
+    (hour_start, caller_number, total_calls, calls_over_45s, billsec_sum)
+    SELECT start_stamp - start_stamp % 3600 AS hour_start,
+           caller_id_number AS caller_number,
+           COUNT(*),
+           SUM(billsec > ?),
+           SUM(billsec)
+    FROM calls
+    WHERE accountcode = 'outbound'
+    AND start_stamp >= ? AND start_stamp < ?
+    AND length(caller_id_number) > 3
+'''
+
+def log_db_diagnostics():
+    """Подробности о файле БД и рабочем каталоге для разбора проблем с правами и томами.
+    Выполняется только при DB_DIAGNOSTICS=1: обычный старт воркера каталог не обходит"""
+    import stat
+    logging.info(f"=== DATABASE DIAGNOSTICS ===")
     logging.info(f"DB_FILE path: {DB_FILE}")
     logging.info(f"Current working directory: {os.getcwd()}")
     logging.info(f"DB file exists: {os.path.exists(DB_FILE)}")
     logging.info(f"Current user: {os.getuid() if hasattr(os, 'getuid') else 'Windows'}")
     
-    # ДЕТАЛЬНАЯ ИНФОРМАЦИЯ О ФАЙЛЕ БД
     if os.path.exists(DB_FILE):
-        import stat
         file_stat = os.stat(DB_FILE)
-        logging.info(f"=== FILE DETAILS ===")
         logging.info(f"File size: {file_stat.st_size} bytes")
-        logging.info(f"File mode (octal): {oct(file_stat.st_mode)}")
         logging.info(f"File permissions: {stat.filemode(file_stat.st_mode)}")
-        logging.info(f"File owner UID: {file_stat.st_uid}")
-        logging.info(f"File group GID: {file_stat.st_gid}")
+        logging.info(f"File owner UID: {file_stat.st_uid}, GID: {file_stat.st_gid}")
         logging.info(f"Is regular file: {stat.S_ISREG(file_stat.st_mode)}")
-        logging.info(f"Is directory: {stat.S_ISDIR(file_stat.st_mode)}")
-        logging.info(f"Is link: {stat.S_ISLNK(file_stat.st_mode)}")
-        
-        # Проверяем, можем ли читать/писать
-        logging.info(f"Can read: {os.access(DB_FILE, os.R_OK)}")
-        logging.info(f"Can write: {os.access(DB_FILE, os.W_OK)}")
-        logging.info(f"Can execute: {os.access(DB_FILE, os.X_OK)}")
-        
-        # Пробуем открыть файл для чтения
+        logging.info(f"Can read: {os.access(DB_FILE, os.R_OK)}, can write: {os.access(DB_FILE, os.W_OK)}")
         try:
             with open(DB_FILE, 'rb') as f:
-                content = f.read(16)
-                logging.info(f"File content (first 16 bytes): {content}")
+                logging.info(f"File content (first 16 bytes): {f.read(16)}")
         except Exception as e:
             logging.error(f"Cannot read file: {e}")
     
-    # Список всех файлов в текущей директории
-    logging.info(f"=== FILES IN CURRENT DIRECTORY ===")
     try:
-        files = os.listdir('.')
-        for f in files:
-            fstat = os.stat(f)
-            logging.info(f"  {f}: size={fstat.st_size}, mode={oct(fstat.st_mode)}")
+        for name in os.listdir('.'):
+            fstat = os.stat(name)
+            logging.info(f"  {name}: size={fstat.st_size}, mode={oct(fstat.st_mode)}")
     except Exception as e:
         logging.error(f"Cannot list directory: {e}")
     
-    # Проверяем права доступа к текущей директории
     try:
         test_file = 'test_write_permissions.tmp'
         with open(test_file, 'w') as f:
@@ -147,90 +399,51 @@ def init_db():
         logging.info(f"Write permissions in current dir: OK")
     except Exception as e:
         logging.error(f"Write permissions in current dir: FAILED - {e}")
-    
-    # Пытаемся создать директорию, если нужно
-    db_dir = os.path.dirname(DB_FILE)
-    if db_dir and not os.path.exists(db_dir):
-        logging.info(f"Creating directory: {db_dir}")
-        os.makedirs(db_dir, exist_ok=True)
-    
-    logging.info(f"Attempting to connect to database...")
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        logging.info(f"Database connection: SUCCESS")
-    except Exception as e:
-        logging.error(f"Database connection: FAILED - {e}")
-        logging.error(f"Exception type: {type(e)}")
-        import traceback
-        logging.error(f"Traceback: {traceback.format_exc()}")
-        
-        # Пробуем удалить файл/директорию и создать заново
-        logging.info(f"=== ATTEMPTING TO RECREATE DATABASE FILE ===")
-        try:
-            if os.path.exists(DB_FILE):
-                logging.info(f"Removing existing file/directory...")
-                if os.path.isdir(DB_FILE):
-                    logging.info(f"Removing directory: {DB_FILE}")
-                    import shutil
-                    shutil.rmtree(DB_FILE)
-                else:
-                    logging.info(f"Removing file: {DB_FILE}")
-                    os.remove(DB_FILE)
-                logging.info(f"File/directory removed successfully")
-            
-            logging.info(f"Creating new database file...")
-            conn = sqlite3.connect(DB_FILE)
-            logging.info(f"Database connection after recreation: SUCCESS")
-        except Exception as e2:
-            logging.error(f"Recreation also failed: {e2}")
-            import traceback
-            logging.error(f"Traceback: {traceback.format_exc()}")
-            raise
-    cursor = conn.cursor()
-    
-    # Проверяем, существует ли таблица calls со старой структурой
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='calls'")
-    table_exists = cursor.fetchone() is not None
-    
-    if table_exists:
-        # Проверяем наличие колонки end_stamp
-        cursor.execute("PRAGMA table_info(calls)")
-        columns = [column[1] for column in cursor.fetchall()]
-        if 'end_stamp' not in columns or 'call_data' not in columns:
-            logging.info('Old table structure detected, recreating calls table...')
-            cursor.execute('DROP TABLE IF EXISTS calls')
-            table_exists = False
-    
-    # Таблица для хранения звонков
-    if not table_exists:
-        cursor.execute('''
-            CREATE TABLE calls (
-                id TEXT PRIMARY KEY,
-                start_stamp INTEGER NOT NULL,
-                end_stamp INTEGER NOT NULL,
-                caller_id_number TEXT,
-                destination_number TEXT,
-                billsec INTEGER,
-                duration INTEGER,
-                accountcode TEXT,
-                gateway TEXT,
-                caller_id_name TEXT,
-                description TEXT,
-                call_data TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        logging.info('Created calls table with new structure')
-    
-    # Индексы для быстрого поиска по временным интервалам
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_start_stamp ON calls(start_stamp)
-    ''')
+
+def table_exists(cursor, name):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,))
+    return cursor.fetchone() is not None
+
+def table_columns(cursor, name):
+    cursor.execute(f'PRAGMA table_info({name})')
+    return {column[1] for column in cursor.fetchall()}
+
+# Миграции схемы. БД без user_version (созданные до появления миграций) могут быть
+# в любом промежуточном состоянии, поэтому каждая миграция проверяет, что уже сделано
+
+def migrate_base_tables(cursor):
+    """Звонки, номера и дневная статистика"""
     cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_end_stamp ON calls(end_stamp)
+        CREATE TABLE IF NOT EXISTS calls (
+            id TEXT PRIMARY KEY,
+            start_stamp INTEGER NOT NULL,
+            end_stamp INTEGER NOT NULL,
+            caller_id_number TEXT,
+            destination_number TEXT,
+            billsec INTEGER,
+            duration INTEGER,
+            accountcode TEXT,
+            gateway TEXT,
+            caller_id_name TEXT,
+            description TEXT,
+            call_data TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
     ''')
+    # Самые ранние версии таблицы были без end_stamp и call_data: дополняем, а не пересоздаём
+    columns = table_columns(cursor, 'calls')
+    if 'end_stamp' not in columns:
+        cursor.execute('ALTER TABLE calls ADD COLUMN end_stamp INTEGER NOT NULL DEFAULT 0')
+        cursor.execute('UPDATE calls SET end_stamp = start_stamp + COALESCE(duration, 0)')
+        logging.info('Added end_stamp column to calls table')
+    if 'call_data' not in columns:
+        cursor.execute('ALTER TABLE calls ADD COLUMN call_data TEXT')
+        logging.info('Added call_data column to calls table')
+    
+    # Индексы для быстрого поиска по временным интервалам
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_start_stamp ON calls(start_stamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_end_stamp ON calls(end_stamp)')
     
-    # Таблица для хранения trunk'ов (номеров)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS trunks (
             number TEXT PRIMARY KEY,
@@ -240,18 +453,6 @@ def init_db():
         )
     ''')
     
-    # Таблица для кеша запросов (для отслеживания запрошенных периодов)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS cache_requests (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            request_hash TEXT UNIQUE,
-            start_stamp INTEGER,
-            end_stamp INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Таблица для статистики по дням
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS daily_stats (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -268,133 +469,617 @@ def init_db():
             UNIQUE(date, caller_number)
         )
     ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_date ON daily_stats(date)')
+
+def migrate_content_hash(cursor):
+    """Хеш содержимого звонка: неизменившиеся звонки не перезаписываются"""
+    if 'content_hash' not in table_columns(cursor, 'calls'):
+        cursor.execute('ALTER TABLE calls ADD COLUMN content_hash TEXT')
+
+def migrate_covered_intervals(cursor):
+    """Покрытые кешем интервалы вместо точных хешей запросов в cache_requests"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS covered_intervals (
+            start_stamp INTEGER NOT NULL,
+            end_stamp INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_covered_start ON covered_intervals(start_stamp)')
     
-    # Индекс для быстрого поиска по дате
+    if table_exists(cursor, 'cache_requests'):
+        # Хвост периода, запрошенный "на сейчас", мог быть неполным - отрезаем его
+        cursor.execute('''
+            SELECT start_stamp, MIN(end_stamp, CAST(strftime('%s', created_at) AS INTEGER) - ?)
+            FROM cache_requests
+        ''', (CACHE_SETTLE_SECONDS,))
+        legacy_periods = cursor.fetchall()
+        for start_stamp, end_stamp in legacy_periods:
+            if start_stamp is not None and end_stamp is not None and end_stamp >= start_stamp:
+                mark_period_covered(cursor, start_stamp, end_stamp)
+        cursor.execute('DROP TABLE cache_requests')
+        logging.info(f'Migrated {len(legacy_periods)} cache_requests rows to covered_intervals')
+
+def migrate_hourly_rollup(cursor):
+    """Почасовые агрегаты по номерам и покрывающий индекс для агрегации по звонкам"""
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_calls_outbound_stats
+        ON calls(accountcode, start_stamp, caller_id_number, billsec)
+    ''')
+    hourly_exists = table_exists(cursor, 'hourly_caller_stats')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS hourly_caller_stats (
+            hour_start INTEGER NOT NULL,
+            caller_number TEXT NOT NULL,
+            total_calls INTEGER NOT NULL,
+            calls_over_45s INTEGER NOT NULL,
+            billsec_sum INTEGER NOT NULL,
+            PRIMARY KEY (hour_start, caller_number)
+        ) WITHOUT ROWID
+    ''')
+    if not hourly_exists:
+        # Заполняем агрегаты по уже накопленной истории
+        cursor.execute(HOURLY_ROLLUP_SQL + 'GROUP BY hour_start, caller_number',
+                       (LONG_CALL_SECONDS, 0, 2 ** 62))
+        logging.info(f'Built hourly_caller_stats rollup: {cursor.rowcount} rows')
+
+def migrate_ingest_state(cursor):
+    """Состояние фоновой загрузки и аренды (lease) для координации между воркерами"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at INTEGER NOT NULL
+        )
+    ''')
+
+def migrate_period_stats(cursor):
+    """Материализованные агрегаты daily_stats по неделям и месяцам"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_periods (
+            period_type TEXT NOT NULL,
+            period_key TEXT NOT NULL,
+            period_start TEXT NOT NULL,
+            period_end TEXT NOT NULL,
+            refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (period_type, period_key)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS period_caller_stats (
+            period_type TEXT NOT NULL,
+            period_key TEXT NOT NULL,
+            caller_number TEXT NOT NULL,
+            description TEXT,
+            total_calls INTEGER NOT NULL,
+            calls_over_45s INTEGER NOT NULL,
+            PRIMARY KEY (period_type, period_key, caller_number)
+        ) WITHOUT ROWID
+    ''')
+
+def migrate_calls_paging(cursor):
+    """Keyset-индекс для /api/calls и версии данных для ETag кешированных страниц"""
     cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_date ON daily_stats(date)
+        CREATE INDEX IF NOT EXISTS idx_calls_outbound_keyset ON calls(accountcode, start_stamp, id)
     ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    ''')
+
+# Порядок менять нельзя: номер миграции = её позиция в списке, новые добавляются в конец
+MIGRATIONS = [
+    migrate_base_tables,
+    migrate_content_hash,
+    migrate_covered_intervals,
+    migrate_hourly_rollup,
+    migrate_ingest_state,
+    migrate_period_stats,
+    migrate_calls_paging,
+]
+
+def init_db():
+    """Приводит схему БД к последней версии (PRAGMA user_version).
+    Миграции применяются по одной, каждая в своей транзакции, существующие данные сохраняются"""
+    if DB_DIAGNOSTICS:
+        log_db_diagnostics()
+    
+    db_dir = os.path.dirname(DB_FILE)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+    
+    # Транзакциями управляем сами: DDL и user_version должны фиксироваться вместе
+    conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT, isolation_level=None)
+    try:
+        # WAL хранится в самом файле БД: читатели и писатель из разных воркеров не блокируют друг друга
+        conn.execute('PRAGMA journal_mode=WAL')
+        cursor = conn.cursor()
+        target_version = len(MIGRATIONS)
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        if version > target_version:
+            logging.warning(f'Database schema version {version} is newer than this code ({target_version})')
+        
+        while version < target_version:
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                # Пока ждали блокировку, схему мог обновить другой процесс
+                version = cursor.execute('PRAGMA user_version').fetchone()[0]
+                if version < target_version:
+                    migration = MIGRATIONS[version]
+                    started = time.time()
+                    migration(cursor)
+                    version += 1
+                    cursor.execute(f'PRAGMA user_version = {version}')
+                    logging.info(f'Applied migration {version} ({migration.__name__}) '
+                                 f'in {time.time() - started:.2f}s')
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+    finally:
+        conn.close()
+    logging.info(f'Database schema version {version}')
+
+def get_lease_owner():
+    """Идентификатор владельца аренды: процесс и поток"""
+    return f"{os.getpid()}:{threading.get_ident()}"
+
+def acquire_lease(name, ttl_seconds, owner=None):
+    """Пытается захватить (или продлить) именованную аренду. Возвращает True при успехе"""
+    owner = owner or get_lease_owner()
+    now = int(time.time())
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('''
+            INSERT INTO leases (name, owner, expires_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE leases.expires_at < ? OR leases.owner = excluded.owner
+        ''', (name, owner, now + ttl_seconds, now))
+        acquired = cursor.rowcount > 0
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    return acquired
+
+def release_lease(name, owner=None):
+    """Освобождает аренду, если она принадлежит владельцу"""
+    owner = owner or get_lease_owner()
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+def single_flight(key, func, is_done):
+    """Выполняет func один раз для ключа среди потоков процесса и воркеров.
+    Ожидавшие в процессе получают результат первого; если первый упал или не дождались его,
+    is_done() решает, нужно ли выполнять func самим. Возвращает ошибку или None"""
+    with _inflight_lock:
+        flight = _inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = {'event': threading.Event(), 'result': None, 'failed': False}
+            _inflight[key] = flight
+    
+    if not leader:
+        logging.info(f'Waiting for in-process fetch {key}')
+        if flight['event'].wait(SINGLE_FLIGHT_TIMEOUT) and not flight['failed']:
+            return flight['result']
+        if is_done():
+            return None
+        logging.warning(f'In-process fetch {key} failed or timed out, fetching ourselves')
+        return run_with_lease(f'fetch:{key}', func, is_done)
+    
+    try:
+        flight['result'] = run_with_lease(f'fetch:{key}', func, is_done)
+        return flight['result']
+    except Exception:
+        flight['failed'] = True
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        flight['event'].set()
+
+def run_with_lease(name, func, is_done=None):
+    """Выполняет func под арендой. Если аренду держит другой воркер, ждёт её освобождения
+    (не дольше SINGLE_FLIGHT_TIMEOUT) и выполняет func сам, только если is_done() показывает,
+    что другой воркер работу не сделал. Без is_done работа другого воркера считается сделанной"""
+    deadline = time.monotonic() + SINGLE_FLIGHT_TIMEOUT
+    waited = False
+    while not acquire_lease(name, SINGLE_FLIGHT_TIMEOUT):
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f'Lease {name} is still held by another worker after {SINGLE_FLIGHT_TIMEOUT}s')
+        waited = True
+        time.sleep(0.2)
     
-    conn.commit()
-    conn.close()
-    logging.info('Database initialized successfully')
+    try:
+        if waited:
+            if is_done is None or is_done():
+                logging.info(f'Fetch {name} was done by another worker')
+                return None
+            # Другой воркер упал или его аренда истекла - делаем работу сами
+            logging.warning(f'Fetch {name} was not completed by another worker, retrying')
+        return func()
+    finally:
+        release_lease(name)
 
-def get_request_hash(start_stamp, end_stamp):
-    """Создает хеш для идентификации уникального запроса"""
-    return hashlib.md5(f"{start_stamp}_{end_stamp}".encode()).hexdigest()
+def get_ingest_state():
+    """Возвращает состояние фоновой загрузки в виде словаря"""
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT key, value FROM ingest_state')
+    rows = cursor.fetchall()
+    
+    return dict(rows)
 
-def is_period_cached(start_stamp, end_stamp):
-    """Проверяет, есть ли данные за указанный период в кеше"""
-    conn = sqlite3.connect(DB_FILE)
+def set_ingest_state(**values):
+    """Сохраняет значения состояния фоновой загрузки"""
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.executemany('''
+            INSERT INTO ingest_state (key, value, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+        ''', list(values.items()))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def bump_data_versions(cursor, names):
+    """Увеличивает версии данных (дата 'YYYY-MM-DD' или 'trunks') в текущей транзакции"""
+    cursor.executemany('''
+        INSERT INTO data_versions (name, version) VALUES (?, 1)
+        ON CONFLICT(name) DO UPDATE SET version = version + 1
+    ''', [(name,) for name in names])
+
+def get_data_versions(*names):
+    """Текущие версии данных; для ещё не менявшихся данных - 0"""
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    cursor.execute(f'''
+        SELECT name, version FROM data_versions WHERE name IN ({', '.join('?' * len(names))})
+    ''', names)
+    versions = dict(cursor.fetchall())
+    
+    return [versions.get(name, 0) for name in names]
+
+def mark_period_covered(cursor, start_stamp, end_stamp):
+    """Добавляет интервал в индекс покрытия, объединяя его с пересекающимися и соседними"""
+    cursor.execute('''
+        SELECT MIN(start_stamp), MAX(end_stamp) FROM covered_intervals
+        WHERE end_stamp >= ? AND start_stamp <= ?
+    ''', (start_stamp - 1, end_stamp + 1))
+    
+    merged_start, merged_end = cursor.fetchone()
+    if merged_start is not None:
+        start_stamp = min(start_stamp, merged_start)
+        end_stamp = max(end_stamp, merged_end)
+    
+    cursor.execute('''
+        DELETE FROM covered_intervals
+        WHERE end_stamp >= ? AND start_stamp <= ?
+    ''', (start_stamp - 1, end_stamp + 1))
+    cursor.execute('''
+        INSERT INTO covered_intervals (start_stamp, end_stamp)
+        VALUES (?, ?)
+    ''', (start_stamp, end_stamp))
+
+def get_uncovered_gaps(start_stamp, end_stamp):
+    """Возвращает список участков периода, которых ещё нет в кеше"""
+    conn = get_db()
     cursor = conn.cursor()
     
-    # Проверяем, есть ли запись о таком запросе
-    request_hash = get_request_hash(start_stamp, end_stamp)
     cursor.execute('''
-        SELECT COUNT(*) FROM cache_requests 
-        WHERE request_hash = ?
-    ''', (request_hash,))
+        SELECT start_stamp, end_stamp FROM covered_intervals
+        WHERE end_stamp >= ? AND start_stamp <= ?
+        ORDER BY start_stamp
+    ''', (start_stamp, end_stamp))
+    
+    rows = cursor.fetchall()
+    
+    gaps = []
+    position = start_stamp
+    for covered_start, covered_end in rows:
+        if covered_start > position:
+            gaps.append((position, covered_start - 1))
+        position = max(position, covered_end + 1)
+    if position <= end_stamp:
+        gaps.append((position, end_stamp))
     
-    cached = cursor.fetchone()[0] > 0
-    conn.close()
+    return gaps
+
+def is_period_cached(start_stamp, end_stamp):
+    """Проверяет, полностью ли период покрыт данными в кеше"""
+    return not get_uncovered_gaps(start_stamp, end_stamp)
+
+def cover_period(cursor, start_stamp, end_stamp):
+    """Отмечает период как покрытый, кроме свежего хвоста, где ещё могут появиться звонки"""
+    covered_end = min(end_stamp, int(time.time()) - CACHE_SETTLE_SECONDS)
+    if covered_end >= start_stamp:
+        mark_period_covered(cursor, start_stamp, covered_end)
+
+def save_period_covered(start_stamp, end_stamp):
+    """Отмечает период как покрытый в отдельной транзакции"""
+    conn = get_db()
+    cursor = conn.cursor()
     
-    return cached
+    try:
+        cover_period(cursor, start_stamp, end_stamp)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def call_to_row(call):
+    """Строка таблицы calls для звонка"""
+    # Используем уникальный идентификатор звонка (если есть) или создаем свой
+    call_id = call.get('id') or call.get('uuid') or hashlib.md5(
+        f"{call.get('start_stamp')}_{call.get('caller_id_number')}_{call.get('destination_number')}".encode()
+    ).hexdigest()
+    call_data = json.dumps(call, sort_keys=True, ensure_ascii=False)
+    
+    return (
+        call_id,
+        call.get('start_stamp', 0),
+        call.get('end_stamp', 0),
+        call.get('caller_id_number', ''),
+        call.get('destination_number', ''),
+        call.get('billsec', 0),
+        call.get('duration', 0),
+        call.get('accountcode', ''),
+        call.get('gateway', ''),
+        call.get('caller_id_name', ''),
+        call.get('description', ''),
+        call_data,
+        hashlib.md5(call_data.encode()).hexdigest()
+    )
+
+def refresh_hourly_stats(cursor, hours):
+    """Пересчитывает почасовые агрегаты за указанные часы (в текущей транзакции)"""
+    for hour_start in sorted(hours):
+        cursor.execute('DELETE FROM hourly_caller_stats WHERE hour_start = ?', (hour_start,))
+        cursor.execute(HOURLY_ROLLUP_SQL + 'GROUP BY caller_id_number',
+                       (LONG_CALL_SECONDS, hour_start, hour_start + 3600))
 
-def save_calls_to_cache(calls, start_stamp, end_stamp):
-    """Сохраняет звонки в кеш"""
-    conn = sqlite3.connect(DB_FILE)
+def save_calls_to_cache(calls, start_stamp, end_stamp, mark_covered=True):
+    """Сохраняет звонки в кеш пачками по SAVE_BATCH_SIZE (calls может быть генератором).
+    mark_covered=False - период загружен не полностью. Возвращает число сохранённых звонков,
+    ошибки записи и чтения источника пробрасывает"""
+    conn = get_db()
     cursor = conn.cursor()
+    saved = 0
+    changed = 0
+    write_seconds = 0.0
+    calls = iter(calls)
     
     try:
-        # Сохраняем каждый звонок
-        for call in calls:
-            # Используем уникальный идентификатор звонка (если есть) или создаем свой
-            call_id = call.get('id') or call.get('uuid') or hashlib.md5(
-                f"{call.get('start_stamp')}_{call.get('caller_id_number')}_{call.get('destination_number')}".encode()
-            ).hexdigest()
+        while True:
+            batch = list(itertools.islice(calls, SAVE_BATCH_SIZE))
+            if not batch:
+                break
             
+            # Замеряем только запись в БД, без чтения данных из источника
+            write_started = time.perf_counter()
+            rows = [call_to_row(call) for call in batch]
+            # Где звонки лежали до записи: изменившийся звонок мог переехать в другой час (и день)
             cursor.execute('''
-                INSERT OR REPLACE INTO calls 
+                SELECT id, start_stamp, content_hash FROM calls
+                WHERE id IN (SELECT value FROM json_each(?))
+            ''', (json.dumps([row[0] for row in rows]),))
+            stored = {call_id: (start_stamp, content_hash) for call_id, start_stamp, content_hash in cursor.fetchall()}
+            cursor.executemany('''
+                INSERT INTO calls 
                 (id, start_stamp, end_stamp, caller_id_number, destination_number, 
-                 billsec, duration, accountcode, gateway, caller_id_name, description, call_data)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                call_id,
-                call.get('start_stamp', 0),
-                call.get('end_stamp', 0),
-                call.get('caller_id_number', ''),
-                call.get('destination_number', ''),
-                call.get('billsec', 0),
-                call.get('duration', 0),
-                call.get('accountcode', ''),
-                call.get('gateway', ''),
-                call.get('caller_id_name', ''),
-                call.get('description', ''),
-                json.dumps(call)
-            ))
-        
-        # Сохраняем информацию о запросе
-        request_hash = get_request_hash(start_stamp, end_stamp)
-        cursor.execute('''
-            INSERT OR REPLACE INTO cache_requests 
-            (request_hash, start_stamp, end_stamp)
-            VALUES (?, ?, ?)
-        ''', (request_hash, start_stamp, end_stamp))
+                 billsec, duration, accountcode, gateway, caller_id_name, description, call_data, content_hash)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    start_stamp = excluded.start_stamp,
+                    end_stamp = excluded.end_stamp,
+                    caller_id_number = excluded.caller_id_number,
+                    destination_number = excluded.destination_number,
+                    billsec = excluded.billsec,
+                    duration = excluded.duration,
+                    accountcode = excluded.accountcode,
+                    gateway = excluded.gateway,
+                    caller_id_name = excluded.caller_id_name,
+                    description = excluded.description,
+                    call_data = excluded.call_data,
+                    content_hash = excluded.content_hash
+                WHERE calls.content_hash IS NOT excluded.content_hash
+            ''', rows)
+            # Неизменившиеся звонки не перезаписываются (ни строка, ни индексы)
+            batch_changed = cursor.rowcount
+            changed += batch_changed
+            if batch_changed:
+                hours = {call.get('start_stamp', 0) // 3600 * 3600 for call in batch}
+                # Старые часы перезаписанных звонков, иначе звонок останется учтён и там
+                hours.update(stored[row[0]][0] // 3600 * 3600 for row in rows
+                             if row[0] in stored and stored[row[0]][1] != row[-1])
+                refresh_hourly_stats(cursor, hours)
+                bump_data_versions(cursor, {datetime.fromtimestamp(hour).strftime('%Y-%m-%d') for hour in hours})
+            
+            # Коммитим пачку, чтобы не держать блокировку записи всё время загрузки
+            conn.commit()
+            write_seconds += time.perf_counter() - write_started
+            observe('pbx_stage_seconds', time.perf_counter() - write_started, stage='db_write_calls')
+            saved += len(batch)
         
-        conn.commit()
-        logging.info(f'Saved {len(calls)} calls to cache for period {start_stamp}-{end_stamp}')
+        if mark_covered:
+            cover_period(cursor, start_stamp, end_stamp)
+            conn.commit()
+        rate = saved / write_seconds if write_seconds > 0 else 0
+        logging.info(f'Saved {saved} calls to cache for period {start_stamp}-{end_stamp} '
+                     f'({changed} written, {saved - changed} unchanged) in {write_seconds:.3f}s ({rate:.0f} rows/s)')
     except Exception as e:
+        # Ошибка записи или источника данных (например, обрыв потока из API) - пробрасываем вызывающему:
+        # период без всех звонков нельзя отмечать покрытым
         logging.error(f'Error saving calls to cache: {e}')
         conn.rollback()
-    finally:
-        conn.close()
+        raise
+    
+    return saved
 
 def get_calls_from_cache(start_stamp, end_stamp):
-    """Получает звонки из кеша за указанный период"""
-    conn = sqlite3.connect(DB_FILE)
+    """Получает звонки из кеша за указанный период.
+    Читаются только нужные страницам колонки; полный call_data - через get_call_details()"""
+    with timed('db_read_calls'):
+        conn = get_db()
+        cursor = conn.cursor()
+        
+        cursor.execute(f'''
+            SELECT {', '.join(CALL_COLUMNS)} FROM calls 
+            WHERE start_stamp >= ? AND start_stamp <= ?
+            AND accountcode = 'outbound'
+            ORDER BY start_stamp DESC
+        ''', (start_stamp, end_stamp))
+        
+        rows = cursor.fetchall()
+        
+        calls = [dict(zip(CALL_COLUMNS, row)) for row in rows]
+    logging.info(f'Retrieved {len(calls)} calls from cache for period {start_stamp}-{end_stamp}')
+    return calls
+
+def get_calls_page(start_stamp, end_stamp, cursor=None, limit=CALLS_PAGE_SIZE):
+    """Страница звонков за период в порядке (start_stamp, id) по убыванию.
+    cursor - (start_stamp, id) последнего звонка предыдущей страницы; возвращает (звонки, следующий cursor)"""
+    conn = get_db()
+    db_cursor = conn.cursor()
+    
+    keyset = ''
+    params = [start_stamp, end_stamp]
+    if cursor:
+        keyset = 'AND (c.start_stamp < ? OR (c.start_stamp = ? AND c.id < ?))'
+        params += [cursor[0], cursor[0], cursor[1]]
+    
+    columns = ', '.join(f'c.{column}' for column in CALL_COLUMNS if column != 'description')
+    with timed('db_read_calls_page'):
+        db_cursor.execute(f'''
+            SELECT {columns}, t.description FROM calls c
+            LEFT JOIN trunks t ON t.number = c.caller_id_number
+            WHERE c.accountcode = 'outbound' AND c.start_stamp >= ? AND c.start_stamp <= ?
+            {keyset}
+            ORDER BY c.start_stamp DESC, c.id DESC
+            LIMIT ?
+        ''', (*params, limit + 1))
+        rows = db_cursor.fetchall()
+    
+    names = [column for column in CALL_COLUMNS if column != 'description'] + ['description']
+    calls = [dict(zip(names, row)) for row in rows[:limit]]
+    for call in calls:
+        call['formatted_start_stamp'] = format_timestamp(call.get('start_stamp', 0))
+        call['description'] = call['description'] or ''
+    
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = (calls[-1]['start_stamp'], calls[-1]['id'])
+    return calls, next_cursor
+
+def get_last_call_rowid():
+    """rowid последней записанной строки calls - точка отсчёта для живой ленты"""
+    conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute('''
-        SELECT call_data FROM calls 
-        WHERE start_stamp >= ? AND start_stamp <= ?
-        AND accountcode = 'outbound'
-        ORDER BY start_stamp DESC
-    ''', (start_stamp, end_stamp))
+    cursor.execute('SELECT MAX(rowid) FROM calls')
+    return cursor.fetchone()[0] or 0
+
+def get_new_calls(after_rowid, start_stamp, limit=CALLS_PAGE_MAX_SIZE):
+    """Исходящие звонки, записанные после строки after_rowid, с началом не раньше start_stamp.
+    Возвращает (звонки, rowid последней просмотренной строки)"""
+    conn = get_db()
+    cursor = conn.cursor()
     
+    names = [column for column in CALL_COLUMNS if column != 'description']
+    cursor.execute(f'''
+        SELECT c.rowid, {', '.join(f'c.{column}' for column in names)}, t.description FROM calls c
+        LEFT JOIN trunks t ON t.number = c.caller_id_number
+        WHERE c.rowid > ?
+        ORDER BY c.rowid
+        LIMIT ?
+    ''', (after_rowid, limit))
     rows = cursor.fetchall()
-    conn.close()
     
-    calls = [json.loads(row[0]) for row in rows]
-    logging.info(f'Retrieved {len(calls)} calls from cache for period {start_stamp}-{end_stamp}')
-    return calls
+    calls = []
+    for row in rows:
+        call = dict(zip(names + ['description'], row[1:]))
+        if call['accountcode'] != 'outbound' or (call['start_stamp'] or 0) < start_stamp:
+            continue
+        call['formatted_start_stamp'] = format_timestamp(call.get('start_stamp', 0))
+        call['description'] = call['description'] or ''
+        calls.append(call)
+    
+    return calls, (rows[-1][0] if rows else after_rowid)
+
+def get_call_details(call_id):
+    """Полные данные звонка (включая events) из кеша или None"""
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT call_data FROM calls WHERE id = ?', (call_id,))
+    row = cursor.fetchone()
+    
+    return json.loads(row[0]) if row and row[0] else None
 
 def save_trunks_to_cache(trunks_data):
     """Сохраняет данные о trunk'ах в кеш"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
+        cursor.execute('SELECT number, description FROM trunks')
+        old_descriptions = dict(cursor.fetchall())
+        descriptions_changed = False
+        
         for trunk in trunks_data:
             number = trunk.get('number', '')
             description = trunk.get('description', '')
             
             if number:
+                descriptions_changed |= old_descriptions.get(number) != description
                 cursor.execute('''
                     INSERT OR REPLACE INTO trunks 
                     (number, description, trunk_data, updated_at)
                     VALUES (?, ?, ?, CURRENT_TIMESTAMP)
                 ''', (number, description, json.dumps(trunk)))
         
+        # Описания номеров выводятся на страницах всех дней
+        if descriptions_changed:
+            bump_data_versions(cursor, ['trunks'])
         conn.commit()
         logging.info(f'Saved {len(trunks_data)} trunks to cache')
     except Exception as e:
         logging.error(f'Error saving trunks to cache: {e}')
         conn.rollback()
-    finally:
-        conn.close()
 
 def get_trunks_from_cache(max_age_seconds=3600):
     """Получает trunk'и из кеша, если они не старше указанного времени"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Проверяем, есть ли актуальные данные (не старше max_age_seconds)
@@ -404,7 +1089,6 @@ def get_trunks_from_cache(max_age_seconds=3600):
     ''', (max_age_seconds,))
     
     rows = cursor.fetchall()
-    conn.close()
     
     if rows:
         trunks = [json.loads(row[0]) for row in rows]
@@ -414,15 +1098,11 @@ def get_trunks_from_cache(max_age_seconds=3600):
         logging.info('No fresh trunks data in cache')
         return None
 
-def save_daily_stats(caller_stats, start_stamp, end_stamp, date_str):
-    """Сохраняет статистику по номерам за определенный день"""
-    logging.info(f'=== SAVE_DAILY_STATS DEBUG ===')
-    logging.info(f'caller_stats count: {len(caller_stats) if caller_stats else 0}')
-    logging.info(f'date_str: {date_str}')
-    logging.info(f'start_stamp: {start_stamp}, end_stamp: {end_stamp}')
-    
+def save_daily_stats(caller_stats, start_stamp, end_stamp, date_str, force=False):
+    """Сохраняет статистику по номерам за определенный день одной транзакцией.
+    Существующие записи прошлых дней не перезаписываются, если не указан force"""
     if not caller_stats:
-        logging.info('No caller_stats provided, returning')
+        logging.info(f'No caller_stats provided for date {date_str}, nothing to save')
         return
     
     # Определяем, является ли этот день сегодняшним
@@ -430,84 +1110,68 @@ def save_daily_stats(caller_stats, start_stamp, end_stamp, date_str):
     today_str = datetime.now().strftime('%Y-%m-%d')
     is_today = (date_str == today_str)
     
-    conn = sqlite3.connect(DB_FILE)
+    if is_today or force:
+        on_conflict = '''
+            DO UPDATE SET total_calls = excluded.total_calls,
+                          calls_over_45s = excluded.calls_over_45s,
+                          percentage_over_45s = excluded.percentage_over_45s,
+                          description = excluded.description,
+                          start_stamp = excluded.start_stamp,
+                          end_stamp = excluded.end_stamp,
+                          updated_at = CURRENT_TIMESTAMP
+            WHERE daily_stats.total_calls IS NOT excluded.total_calls
+               OR daily_stats.calls_over_45s IS NOT excluded.calls_over_45s
+               OR daily_stats.percentage_over_45s IS NOT excluded.percentage_over_45s
+               OR daily_stats.description IS NOT excluded.description
+               OR daily_stats.start_stamp IS NOT excluded.start_stamp
+               OR daily_stats.end_stamp IS NOT excluded.end_stamp
+        '''
+    else:
+        # Для прошлых дней не обновляем данные
+        on_conflict = 'DO NOTHING'
+    
+    rows = [
+        (
+            date_str,
+            start_stamp,
+            end_stamp,
+            stat['caller_number'],
+            stat.get('description', ''),
+            stat.get('total_calls', 0),
+            stat.get('calls_over_45s', 0),
+            stat.get('percentage_over_45s', 0.0)
+        )
+        for stat in caller_stats if stat.get('caller_number')
+    ]
+    
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
-        logging.info(f'Processing {len(caller_stats)} stats records')
-        for stat in caller_stats:
-            caller_number = stat.get('caller_number', '')
-            if not caller_number:
-                logging.info(f'Skipping stat with empty caller_number: {stat}')
-                continue
-            
-            # Проверяем, есть ли уже запись для этого дня и номера
-            cursor.execute('''
-                SELECT id FROM daily_stats 
-                WHERE date = ? AND caller_number = ?
-            ''', (date_str, caller_number))
-            
-            existing = cursor.fetchone()
-            logging.info(f'Checking caller_number: {caller_number}, existing: {existing is not None}, is_today: {is_today}')
-            
-            if existing and not is_today:
-                # Для прошлых дней не обновляем данные
-                logging.info(f'Skipping update for past date {date_str}, caller_number: {caller_number}')
-                continue
-            
-            if existing:
-                # Обновляем существующую запись (только для сегодняшнего дня)
-                logging.info(f'Updating existing record for {date_str}, caller_number: {caller_number}')
-                cursor.execute('''
-                    UPDATE daily_stats 
-                    SET total_calls = ?,
-                        calls_over_45s = ?,
-                        percentage_over_45s = ?,
-                        description = ?,
-                        start_stamp = ?,
-                        end_stamp = ?,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE date = ? AND caller_number = ?
-                ''', (
-                    stat.get('total_calls', 0),
-                    stat.get('calls_over_45s', 0),
-                    stat.get('percentage_over_45s', 0.0),
-                    stat.get('description', ''),
-                    start_stamp,
-                    end_stamp,
-                    date_str,
-                    caller_number
-                ))
-            else:
-                # Создаем новую запись
-                logging.info(f'Inserting new record for {date_str}, caller_number: {caller_number}')
-                cursor.execute('''
-                    INSERT INTO daily_stats 
-                    (date, start_stamp, end_stamp, caller_number, description, 
-                     total_calls, calls_over_45s, percentage_over_45s)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    date_str,
-                    start_stamp,
-                    end_stamp,
-                    caller_number,
-                    stat.get('description', ''),
-                    stat.get('total_calls', 0),
-                    stat.get('calls_over_45s', 0),
-                    stat.get('percentage_over_45s', 0.0)
-                ))
-        
+        started = time.perf_counter()
+        cursor.executemany(f'''
+            INSERT INTO daily_stats 
+            (date, start_stamp, end_stamp, caller_number, description, 
+             total_calls, calls_over_45s, percentage_over_45s)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(date, caller_number) {on_conflict}
+        ''', rows)
+        # Неизменившиеся строки не обновляются и не считаются: версия дня (ETag) остаётся прежней
+        if cursor.rowcount > 0:
+            # Обновляем только те недельные и месячные агрегаты, в которые попадает этот день
+            refresh_period_stats_for_date(cursor, date_str)
+            bump_data_versions(cursor, [date_str])
         conn.commit()
-        logging.info(f'Saved {len(caller_stats)} stats records for date {date_str}')
+        elapsed = time.perf_counter() - started
+        rate = len(rows) / elapsed if elapsed > 0 else 0
+        logging.info(f'Saved {len(rows)} stats records for date {date_str} in {elapsed:.3f}s ({rate:.0f} rows/s)')
     except Exception as e:
         logging.error(f'Error saving daily stats: {e}')
         conn.rollback()
-    finally:
-        conn.close()
 
 def get_daily_stats_by_date(date_str):
     """Получает статистику за определенный день"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -518,7 +1182,6 @@ def get_daily_stats_by_date(date_str):
     ''', (date_str,))
     
     rows = cursor.fetchall()
-    conn.close()
     
     result = []
     for row in rows:
@@ -534,7 +1197,7 @@ def get_daily_stats_by_date(date_str):
 
 def get_all_stats_dates():
     """Получает список всех дат, для которых есть статистика"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -546,7 +1209,6 @@ def get_all_stats_dates():
     ''')
     
     rows = cursor.fetchall()
-    conn.close()
     
     result = []
     for row in rows:
@@ -561,7 +1223,7 @@ def get_all_stats_dates():
 
 def get_comprehensive_stats():
     """Получает сводную статистику всех номеров по всем дням"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Получаем все уникальные номера
@@ -590,7 +1252,6 @@ def get_comprehensive_stats():
     ''')
     
     stats_data = cursor.fetchall()
-    conn.close()
     
     # Создаем словарь для быстрого поиска
     stats_dict = {}
@@ -632,187 +1293,292 @@ def get_comprehensive_stats():
     
     return result, dates
 
-def get_comprehensive_stats_weekly():
-    """Получает сводную статистику всех номеров по неделям"""
-    from datetime import datetime, timedelta
-    
-    conn = sqlite3.connect(DB_FILE)
+def get_stats_matrix(date_from=None, date_to=None, numbers=None, limit=STATS_MATRIX_COLUMNS):
+    """Сводная статистика по дням в колоночном виде.
+    Возвращает окно из не более чем limit дат (от новых к старым) в диапазоне [date_from, date_to]
+    и плотные массивы значений number x date (по строкам номеров), -1 там, где данных нет"""
+    conn = get_db()
     cursor = conn.cursor()
     
-    # Получаем все уникальные номера
+    conditions = []
+    params = []
+    if date_from:
+        conditions.append('date >= ?')
+        params.append(date_from)
+    if date_to:
+        conditions.append('date <= ?')
+        params.append(date_to)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    
+    # Окно дат; лишняя дата нужна только чтобы понять, есть ли более старые колонки
+    cursor.execute(f'''
+        SELECT DISTINCT date FROM daily_stats {where}
+        ORDER BY date DESC
+        LIMIT ?
+    ''', (*params, limit + 1))
+    dates = [row[0] for row in cursor.fetchall()]
+    more = len(dates) > limit
+    dates = dates[:limit]
+    
+    result = {'dates': dates, 'numbers': [], 'descriptions': [],
+              'total_calls': [], 'calls_over_45s': [], 'more': more}
+    if not dates:
+        return result
+    
+    number_filter = ''
+    number_params = []
+    if numbers:
+        number_filter = f"AND caller_number IN ({', '.join('?' * len(numbers))})"
+        number_params = list(numbers)
+    cursor.execute(f'''
+        SELECT date, caller_number, description, total_calls, calls_over_45s
+        FROM daily_stats
+        WHERE date >= ? AND date <= ? {number_filter}
+        ORDER BY date DESC
+    ''', (dates[-1], dates[0], *number_params))
+    rows = cursor.fetchall()
+    
+    # Номера в порядке первого появления; описание берём из самой свежей даты
+    number_index = {}
+    descriptions = []
+    for _, caller_number, description, _, _ in rows:
+        if caller_number not in number_index:
+            number_index[caller_number] = len(number_index)
+            descriptions.append(description or '')
+    date_index = {date: i for i, date in enumerate(dates)}
+    width = len(dates)
+    
+    total_calls = array('i', [-1]) * (len(number_index) * width)
+    calls_over_45s = array('i', [-1]) * (len(number_index) * width)
+    for date, caller_number, _, total, over_45s in rows:
+        offset = number_index[caller_number] * width + date_index[date]
+        total_calls[offset] = total
+        calls_over_45s[offset] = over_45s
+    
+    # Сортируем номера по количеству звонков за вчерашний день (вторая колонка), если она есть
+    sort_column = 1 if width >= 2 else 0
+    order = sorted(number_index.values(), key=lambda row: max(total_calls[row * width + sort_column], 0), reverse=True)
+    numbers_list = list(number_index)
+    
+    sorted_total = array('i')
+    sorted_over_45s = array('i')
+    for row in order:
+        sorted_total.extend(total_calls[row * width:(row + 1) * width])
+        sorted_over_45s.extend(calls_over_45s[row * width:(row + 1) * width])
+    
+    result['numbers'] = [numbers_list[row] for row in order]
+    result['descriptions'] = [descriptions[row] for row in order]
+    result['total_calls'] = sorted_total.tolist()
+    result['calls_over_45s'] = sorted_over_45s.tolist()
+    return result
+
+def refresh_period_stats(cursor, period_type, period_key, period_start, period_end):
+    """Пересчитывает агрегат daily_stats за период (даты включительно) в текущей транзакции"""
     cursor.execute('''
-        SELECT DISTINCT caller_number, description
-        FROM daily_stats 
-        ORDER BY caller_number
-    ''')
-    
-    numbers = cursor.fetchall()
-    
-    # Получаем все даты
+        DELETE FROM period_caller_stats WHERE period_type = ? AND period_key = ?
+    ''', (period_type, period_key))
     cursor.execute('''
-        SELECT DISTINCT date 
-        FROM daily_stats 
-        ORDER BY date DESC
-    ''')
-    
-    all_dates = [row[0] for row in cursor.fetchall()]
-    
-    if not all_dates:
-        conn.close()
-        return [], []
-    
-    # Группируем даты по неделям
+        INSERT INTO period_caller_stats
+        (period_type, period_key, caller_number, description, total_calls, calls_over_45s)
+        SELECT ?, ?, caller_number, MAX(description), SUM(total_calls), SUM(calls_over_45s)
+        FROM daily_stats
+        WHERE date >= ? AND date <= ?
+        GROUP BY caller_number
+    ''', (period_type, period_key, period_start, period_end))
+    cursor.execute('''
+        INSERT OR REPLACE INTO stats_periods (period_type, period_key, period_start, period_end, refreshed_at)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ''', (period_type, period_key, period_start, period_end))
+
+def refresh_period_stats_for_date(cursor, date_str):
+    """Пересчитывает материализованные периоды, в которые попадает дата"""
+    cursor.execute('''
+        SELECT period_type, period_key, period_start, period_end FROM stats_periods
+        WHERE period_start <= ? AND period_end >= ?
+    ''', (date_str, date_str))
+    for period_type, period_key, period_start, period_end in cursor.fetchall():
+        refresh_period_stats(cursor, period_type, period_key, period_start, period_end)
+
+def get_weekly_periods():
+    """Недельные периоды для статистики: 6 отрезков по 7 дней, заканчивая вчерашним днем"""
+    from datetime import timedelta
     # Определяем недели от вчерашнего дня (данные за сегодня могут быть неполными)
-    today = datetime.now().date()
-    yesterday = today - timedelta(days=1)
+    yesterday = datetime.now().date() - timedelta(days=1)
+    descriptions = ['Последние 7 дней', 'Прошлая неделя']
     
-    # Создаем недельные периоды
     weekly_periods = []
-    
-    # Последние 7 дней (со вчера назад на 6 дней)
-    week_end = yesterday
-    week_start = yesterday - timedelta(days=6)
-    weekly_periods.append({
-        'start': week_start,
-        'end': week_end,
-        'label': f"{week_start.strftime('%d.%m')}-{week_end.strftime('%d.%m')}",
-        'description': 'Последние 7 дней',
-        'key': f"{week_start.isoformat()}_{week_end.isoformat()}"
-    })
-    
-    # Прошлая неделя (с 8 дней назад до 14 дней назад)
-    week_end = yesterday - timedelta(days=7)
-    week_start = week_end - timedelta(days=6)
-    weekly_periods.append({
-        'start': week_start,
-        'end': week_end,
-        'label': f"{week_start.strftime('%d.%m')}-{week_end.strftime('%d.%m')}",
-        'description': 'Прошлая неделя',
-        'key': f"{week_start.isoformat()}_{week_end.isoformat()}"
-    })
-    
-    # Добавляем еще несколько недель назад (до 5 недель)
-    for i in range(2, 6):
-        week_end = yesterday - timedelta(days=7*i)
+    for i in range(6):
+        week_end = yesterday - timedelta(days=7 * i)
         week_start = week_end - timedelta(days=6)
         weekly_periods.append({
             'start': week_start,
             'end': week_end,
             'label': f"{week_start.strftime('%d.%m')}-{week_end.strftime('%d.%m')}",
-            'description': '',
+            'description': descriptions[i] if i < len(descriptions) else '',
             'key': f"{week_start.isoformat()}_{week_end.isoformat()}"
         })
+    return weekly_periods
+
+def get_monthly_periods(count=6):
+    """Календарные месяцы для статистики, начиная с месяца вчерашнего дня"""
+    from datetime import timedelta
+    month_start = (datetime.now().date() - timedelta(days=1)).replace(day=1)
+    
+    monthly_periods = []
+    for i in range(count):
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        month_end = next_month - timedelta(days=1)
+        monthly_periods.append({
+            'start': month_start,
+            'end': month_end,
+            'label': month_start.strftime('%m.%Y'),
+            'description': 'Текущий месяц' if i == 0 else '',
+            'key': month_start.strftime('%Y-%m')
+        })
+        month_start = (month_start - timedelta(days=1)).replace(day=1)
+    return monthly_periods
+
+def get_period_stats(period_type, periods):
+    """Сводная статистика номеров по периодам из материализованных агрегатов.
+    Недостающие периоды пересчитываются один раз, дальше обновляются при сохранении дня"""
+    conn = get_db()
+    cursor = conn.cursor()
+    keys = [period['key'] for period in periods]
+    placeholders = ', '.join('?' * len(keys))
     
-    # Получаем все данные статистики
+    cursor.execute(f'''
+        SELECT period_key FROM stats_periods
+        WHERE period_type = ? AND period_key IN ({placeholders})
+    ''', (period_type, *keys))
+    materialized = {row[0] for row in cursor.fetchall()}
+    
+    missing = [period for period in periods if period['key'] not in materialized]
+    if missing:
+        try:
+            for period in missing:
+                refresh_period_stats(cursor, period_type, period['key'], period['start'].isoformat(), period['end'].isoformat())
+            if period_type == 'week':
+                # Скользящие недели прошлых дней больше не показываются
+                cursor.execute(f'''
+                    DELETE FROM period_caller_stats WHERE period_type = 'week' AND period_key NOT IN ({placeholders})
+                ''', keys)
+                cursor.execute(f'''
+                    DELETE FROM stats_periods WHERE period_type = 'week' AND period_key NOT IN ({placeholders})
+                ''', keys)
+            conn.commit()
+            logging.info(f'Materialized {len(missing)} {period_type} period(s)')
+        except Exception as e:
+            logging.error(f'Error materializing {period_type} stats: {e}')
+            conn.rollback()
+    
+    cursor.execute(f'''
+        SELECT period_key, caller_number, total_calls, calls_over_45s
+        FROM period_caller_stats
+        WHERE period_type = ? AND period_key IN ({placeholders})
+    ''', (period_type, *keys))
+    rows = cursor.fetchall()
+    
+    # Все известные номера, в том числе без звонков в показываемых периодах (у них нули)
     cursor.execute('''
-        SELECT date, caller_number, description, total_calls, calls_over_45s
-        FROM daily_stats 
-        ORDER BY date DESC, caller_number
+        SELECT caller_number, description FROM daily_stats
+        WHERE id IN (SELECT MAX(id) FROM daily_stats GROUP BY caller_number)
+        ORDER BY caller_number
     ''')
+    stats_by_number = {}
+    for caller_number, description in cursor.fetchall():
+        stats_by_number[caller_number] = {
+            'caller_number': caller_number,
+            'description': description or '',
+            'weeks': {key: {'total_calls': 0, 'calls_over_45s': 0, 'percentage_over_45s': 0} for key in keys}
+        }
     
-    stats_data = cursor.fetchall()
-    conn.close()
-    
-    # Создаем словарь для быстрого поиска данных по дате и номеру
-    stats_dict = {}
-    for row in stats_data:
-        date_str, caller_number, description, total_calls, calls_over_45s = row
-        date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
-        
-        if caller_number not in stats_dict:
-            stats_dict[caller_number] = {
-                'description': description or '',
-                'dates': {}
-            }
-        
-        stats_dict[caller_number]['dates'][date_obj] = {
+    for period_key, caller_number, total_calls, calls_over_45s in rows:
+        number_stats = stats_by_number.get(caller_number)
+        if number_stats is None:
+            continue
+        percentage = (calls_over_45s / total_calls * 100) if total_calls > 0 else 0
+        number_stats['weeks'][period_key] = {
             'total_calls': total_calls,
-            'calls_over_45s': calls_over_45s
+            'calls_over_45s': calls_over_45s,
+            'percentage_over_45s': percentage
         }
     
-    # Агрегируем данные по неделям
-    result = []
-    for caller_number, description in numbers:
-        number_stats = {
-            'caller_number': caller_number,
-            'description': description or '',
-            'weeks': {}
-        }
+    # Сортируем по количеству звонков за последний период
+    result = list(stats_by_number.values())
+    if keys:
+        result.sort(key=lambda x: x['weeks'][keys[0]]['total_calls'], reverse=True)
+    
+    return result
+
+def get_comprehensive_stats_weekly():
+    """Получает сводную статистику всех номеров по неделям"""
+    weekly_periods = get_weekly_periods()
+    return get_period_stats('week', weekly_periods), weekly_periods
+
+def get_comprehensive_stats_monthly():
+    """Получает сводную статистику всех номеров по календарным месяцам"""
+    monthly_periods = get_monthly_periods()
+    return get_period_stats('month', monthly_periods), monthly_periods
+
+def get_caller_stats(start_stamp, end_stamp):
+    """Вычисляет статистику по уникальным номерам звонящих за период.
+    Целые часы берутся из hourly_caller_stats, сырые звонки читаются только на краях периода"""
+    with timed('caller_stats'):
+        first_hour = -(-start_stamp // 3600) * 3600
+        last_hour = (end_stamp + 1) // 3600 * 3600
+        if first_hour < last_hour:
+            edges = (start_stamp, first_hour - 1, last_hour, end_stamp)
+        else:
+            # Период короче часа или не содержит целого часа - считаем по сырым звонкам
+            first_hour = last_hour = 0
+            edges = (start_stamp, end_stamp, 1, 0)
         
-        caller_data = stats_dict.get(caller_number, {'dates': {}})
+        conn = get_db()
+        cursor = conn.cursor()
         
-        for week in weekly_periods:
-            total_calls = 0
-            calls_over_45s = 0
-            
-            # Суммируем данные за все дни недели
-            current_date = week['start']
-            while current_date <= week['end']:
-                if current_date in caller_data['dates']:
-                    total_calls += caller_data['dates'][current_date]['total_calls']
-                    calls_over_45s += caller_data['dates'][current_date]['calls_over_45s']
-                current_date += timedelta(days=1)
-            
-            # Вычисляем процент
+        # Трехзначные номера (и короче) пропускаем; описание берём из trunk'ов
+        cursor.execute('''
+            SELECT s.caller_number,
+                   COALESCE(t.description, '') AS description,
+                   SUM(s.total_calls) AS total_calls,
+                   SUM(s.calls_over_45s) AS calls_over_45s
+            FROM (
+                SELECT caller_number, total_calls, calls_over_45s
+                FROM hourly_caller_stats
+                WHERE hour_start >= ? AND hour_start < ?
+                UNION ALL
+                SELECT caller_id_number, 1, billsec > ?
+                FROM calls
+                WHERE accountcode = 'outbound' AND start_stamp >= ? AND start_stamp <= ?
+                AND length(caller_id_number) > 3
+                UNION ALL
+                SELECT caller_id_number, 1, billsec > ?
+                FROM calls
+                WHERE accountcode = 'outbound' AND start_stamp >= ? AND start_stamp <= ?
+                AND length(caller_id_number) > 3
+            ) s
+            LEFT JOIN trunks t ON t.number = s.caller_number
+            GROUP BY s.caller_number
+            ORDER BY total_calls DESC, s.caller_number
+        ''', (first_hour, last_hour,
+              LONG_CALL_SECONDS, edges[0], edges[1],
+              LONG_CALL_SECONDS, edges[2], edges[3]))
+        
+        rows = cursor.fetchall()
+        
+        result = []
+        for caller_number, description, total_calls, calls_over_45s in rows:
             percentage = (calls_over_45s / total_calls * 100) if total_calls > 0 else 0
-            
-            number_stats['weeks'][week['key']] = {
+            result.append({
+                'caller_number': caller_number,
+                'description': description,
                 'total_calls': total_calls,
                 'calls_over_45s': calls_over_45s,
-                'percentage_over_45s': percentage
-            }
-        
-        result.append(number_stats)
-    
-    # Сортируем по количеству звонков за последнюю неделю
-    if weekly_periods:
-        first_week_key = weekly_periods[0]['key']
-        result.sort(key=lambda x: x['weeks'].get(first_week_key, {}).get('total_calls', 0), reverse=True)
-    
-    return result, weekly_periods
-
-def calculate_caller_stats(calls):
-    """Вычисляет статистику по уникальным номерам звонящих"""
-    logging.info(f'=== CALCULATE_CALLER_STATS DEBUG ===')
-    logging.info(f'Processing {len(calls)} calls')
-    stats = {}
-    
-    for call in calls:
-        caller_number = call.get('caller_id_number', '')
-        duration = call.get('billsec', 0)
-        
-        # Пропускаем трехзначные номера (и короче)
-        if caller_number and len(caller_number) > 3:
-            if caller_number not in stats:
-                stats[caller_number] = {
-                    'total_calls': 0,
-                    'calls_over_45s': 0,
-                    'description': call.get('description', '')
-                }
-            
-            stats[caller_number]['total_calls'] += 1
-            if duration > 45:
-                stats[caller_number]['calls_over_45s'] += 1
-    
-    # Преобразуем в список и вычисляем проценты
-    result = []
-    for caller_number, data in stats.items():
-        total_calls = data['total_calls']
-        calls_over_45s = data['calls_over_45s']
-        percentage = (calls_over_45s / total_calls * 100) if total_calls > 0 else 0
+                'percentage_over_45s': round(percentage, 1)
+            })
         
-        result.append({
-            'caller_number': caller_number,
-            'description': data['description'],
-            'total_calls': total_calls,
-            'calls_over_45s': calls_over_45s,
-            'percentage_over_45s': round(percentage, 1)
-        })
-    
-    # Сортируем по количеству звонков (по убыванию)
-    result.sort(key=lambda x: x['total_calls'], reverse=True)
-    logging.info(f'Calculated stats for {len(result)} unique caller numbers')
-    return result
+        logging.info(f'Calculated stats for {len(result)} unique caller numbers for period {start_stamp}-{end_stamp}')
+        return result
 
 def get_trunks_data():
     """Получает данные о trunk'ах (номерах) из API или кеша"""
@@ -841,17 +1607,14 @@ def get_trunks_data():
         'Content-Type': 'application/x-www-form-urlencoded'
     }
     
-    # URL для получения статуса номеров
-    trunks_url = f'https://api2.onlinepbx.ru/{DOMAIN}/trunks/get.json'
-    
     try:
-        response = requests.post(trunks_url, headers=headers, timeout=10)
+        response = pbx_post('trunks', TRUNKS_URL, headers=headers)
         response.raise_for_status()
         
         data = response.json()
         if data.get('isNotAuth'):
             logging.warning('API key expired for trunks, requesting new key...')
-            get_new_api_key()
+            refresh_api_key(api_key)
             return {}
         
         if data.get('status') == '1':
@@ -881,39 +1644,119 @@ app = Flask(__name__)
 # Инициализируем базу данных при старте приложения
 init_db()
 
-def get_calls_data(interval_seconds, title):
-    """Общая функция для получения данных о звонках за указанный интервал"""
-    logging.info(f'Entering get_calls_data function for {title}')
-    now = int(time.time())
-    start_time = now - interval_seconds
+def normalize_call(call, trunks_dict):
+    """Приводит звонок из API к виду, в котором он хранится в кеше"""
+    call['caller_id_number'] = call.get('gateway') or call.get('caller_id_number') or call.get('caller_id_name')
+    call['billsec'] = call.get('billsec', call.get('duration', 0))
+    # Добавляем описание номера из данных о trunk'ах
+    call['description'] = trunks_dict.get(call['caller_id_number'], '')
+    return call
+
+def iter_response_text(response, chunk_size=65536):
+    """Отдаёт тело ответа кусками текста без загрузки целиком в память"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+def iter_json_array(chunks, key=None, meta=None):
+    """Потоково разбирает JSON и отдаёт элементы массива по одному.
+    key=None - массив на верхнем уровне; иначе массив в поле key объекта верхнего уровня,
+    а остальные поля этого объекта складываются в meta"""
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    state = {'buffer': '', 'pos': 0, 'eof': False}
+    
+    def fill():
+        # Подчитываем следующий кусок; обработанное начало буфера отбрасываем
+        if state['pos'] > 65536:
+            state['buffer'] = state['buffer'][state['pos']:]
+            state['pos'] = 0
+        chunk = next(chunks, None)
+        if chunk is None:
+            state['eof'] = True
+            return False
+        state['buffer'] += chunk
+        return True
+    
+    def peek():
+        # Следующий непробельный символ (пустая строка в конце потока)
+        while True:
+            buffer, pos = state['buffer'], state['pos']
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            state['pos'] = pos
+            if pos < len(buffer):
+                return buffer[pos]
+            if not fill():
+                return ''
+    
+    def expect(chars):
+        char = peek()
+        if char not in chars or not char:
+            raise ValueError(f'Unexpected JSON token {char!r}, expected one of {chars!r}')
+        state['pos'] += 1
+        return char
+    
+    def decode_value():
+        peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(state['buffer'], state['pos'])
+                # Число в самом конце буфера может продолжаться в следующем куске,
+                # в том числе после точки, экспоненты или знака ("12." + "5", "1e" + "5")
+                if state['eof'] or state['buffer'][end:].strip('.eE+-'):
+                    state['pos'] = end
+                    return value
+            except json.JSONDecodeError:
+                if state['eof']:
+                    raise
+            fill()
+    
+    def iter_items():
+        expect('[')
+        if peek() == ']':
+            state['pos'] += 1
+            return
+        while True:
+            yield decode_value()
+            if expect(',]') == ']':
+                return
+    
+    if key is None:
+        yield from iter_items()
+        return
+    
+    expect('{')
+    if peek() == '}':
+        return
+    while True:
+        field = decode_value()
+        expect(':')
+        if field == key and peek() == '[':
+            yield from iter_items()
+        else:
+            value = decode_value()
+            if meta is not None:
+                meta[field] = value
+        if expect(',}') == '}':
+            return
+
+def fetch_calls_from_api(start_time, end_time, trunks_dict):
+    """Запрашивает звонки за период из API и сохраняет их в кеш.
+    Возвращает (текст ошибки или None, признак обрезанного ответа)"""
     payload = {
         'start_stamp_from': start_time,
-        'start_stamp_to': now
+        'start_stamp_to': end_time
     }
-    calls = []
     error = None
-    period_label = format_period_label(start_time, now)
-    
-    # Получаем данные о trunk'ах для описаний номеров
-    trunks_dict = get_trunks_data()
-    
-    # Проверяем, есть ли данные в кеше
-    if is_period_cached(start_time, now):
-        logging.info(f'Using cached data for period {start_time}-{now}')
-        calls = get_calls_from_cache(start_time, now)
-        
-        # Добавляем форматированные поля и описания
-        for call in calls:
-            call['formatted_start_stamp'] = format_timestamp(call.get('start_stamp', 0))
-            caller_number = call.get('caller_id_number', '')
-            call['description'] = trunks_dict.get(caller_number, '')
-        
-        # Вычисляем статистику по номерам звонящих
-        caller_stats = calculate_caller_stats(calls)
-        return calls, caller_stats, error, period_label
+    truncated = False
     
-    # Если нет в кеше, запрашиваем из API
-    logging.info(f'Fetching data from API for period {start_time}-{now}')
+    logging.info(f'Fetching data from API for period {start_time}-{end_time}')
     for attempt in range(2):  # максимум 2 попытки: с текущим ключом и с новым
         api_key = get_valid_api_key()
         if not api_key:
@@ -925,34 +1768,35 @@ def get_calls_data(interval_seconds, title):
             'Content-Type': 'application/x-www-form-urlencoded'
         }
         try:
-            response = requests.post(API_URL, data=payload, headers=headers, timeout=10)
-            response.raise_for_status()
-            logging.info(f"API Response Status Code: {response.status_code}")
-            logging.info(f"API Response Body: {response.text}")
-            data = response.json()
-            logging.info(f"Parsed JSON data: {json.dumps(data, indent=2, ensure_ascii=False)}")
-            if data.get('isNotAuth'):
+            # Ответ разбираем потоково: звонки пишутся в БД по мере чтения тела
+            with pbx_post('search', API_URL, data=payload, headers=headers, stream=True) as response:
+                response.raise_for_status()
+                logging.info(f"API Response Status Code: {response.status_code}")
+                meta = {}
+                counters = {'total': 0}
+                
+                def outbound_calls():
+                    for call in iter_json_array(iter_response_text(response), key='data', meta=meta):
+                        counters['total'] += 1
+                        # Фильтруем только исходящие звонки (accountcode = 'outbound')
+                        if call.get('accountcode') == 'outbound':
+                            yield normalize_call(call, trunks_dict)
+                
+                saved = save_calls_to_cache(outbound_calls(), start_time, end_time, mark_covered=False)
+            
+            if meta.get('isNotAuth'):
                 logging.warning('API key expired or invalid, requesting new key...')
-                get_new_api_key()
+                refresh_api_key(api_key)
                 continue  # повторить запрос с новым ключом
-            all_calls = data.get('data', [])
-            # Фильтруем только исходящие звонки (accountcode = 'outbound')
-            calls = [call for call in all_calls if call.get('accountcode') == 'outbound']
-            # Сортируем звонки от новых к старым (по убыванию start_stamp)
-            calls.sort(key=lambda call: call.get('start_stamp', 0), reverse=True)
-            for call in calls:
-                call['caller_id_number'] = call.get('gateway') or call.get('caller_id_number') or call.get('caller_id_name')
-                call['billsec'] = call.get('billsec', call.get('duration', 0))
-                call['formatted_start_stamp'] = format_timestamp(call.get('start_stamp', 0))
-                # Добавляем описание номера из данных о trunk'ах
-                caller_number = call['caller_id_number']
-                call['description'] = trunks_dict.get(caller_number, '')
-            
-            # Сохраняем полученные данные в кеш
-            save_calls_to_cache(calls, start_time, now)
             
-            # Вычисляем статистику по номерам звонящих
-            caller_stats = calculate_caller_stats(calls)
+            logging.info(f"API returned {counters['total']} records, {saved} outbound calls saved")
+            truncated = counters['total'] >= API_MAX_RESULTS
+            if truncated:
+                logging.warning(f"API returned {counters['total']} records for {start_time}-{end_time}, result looks truncated")
+            else:
+                # Обрезанный период не считаем покрытым
+                save_period_covered(start_time, end_time)
+            error = None
             break  # успешный запрос, выходим из цикла
         except requests.exceptions.Timeout:
             error = 'Превышено время ожидания ответа от API.'
@@ -961,44 +1805,411 @@ def get_calls_data(interval_seconds, title):
         except requests.exceptions.RequestException as e:
             if '403' in str(e):
                 logging.warning('API key expired (403 Forbidden), requesting new key...')
-                get_new_api_key()
+                refresh_api_key(api_key)
+                error = f'Ошибка запроса к API: {e}'
                 continue  # повторить запрос с новым ключом
             error = f'Ошибка запроса к API: {e}'
             logging.error(error)
             break
+        except sqlite3.Error as e:
+            error = f'Ошибка сохранения звонков в кеш: {e}'
+            logging.error(error)
+            break
         except Exception as e:
             error = f'Непредвиденная ошибка: {e}'
             logging.error(error)
             break
-    # Инициализируем статистику если не была вычислена
-    if 'caller_stats' not in locals():
-        caller_stats = []
+    else:
+        # Обе попытки закончились отказом в авторизации
+        error = error or 'Не удалось авторизоваться в API.'
     
-    return calls, caller_stats, error, period_label
+    return error, truncated
+
+def split_period(start_time, end_time):
+    """Делит период пополам"""
+    middle = start_time + (end_time - start_time) // 2
+    return [(start_time, middle), (middle + 1, end_time)]
+
+def fetch_calls_range(start_time, end_time, trunks_dict):
+    """Загружает период из API, последовательно деля его на части, пока ответы обрезаны"""
+    error, truncated = fetch_calls_from_api(start_time, end_time, trunks_dict)
+    if error or not truncated:
+        return error
+    
+    if end_time - start_time + 1 <= MIN_SPLIT_SECONDS:
+        logging.warning(f'Period {start_time}-{end_time} is still truncated and too short to split')
+        return None
+    
+    for part_start, part_end in split_period(start_time, end_time):
+        error = fetch_calls_range(part_start, part_end, trunks_dict)
+        if error:
+            return error
+    return None
+
+def ensure_period_cached(start_time, end_time, trunks_dict):
+    """Догружает из API только непокрытые кешем участки периода. Возвращает ошибку или None"""
+    error = None
+    
+    gaps = get_uncovered_gaps(start_time, end_time)
+    
+    # Всё, что новее нижней границы фоновой загрузки, приходит только через неё
+    ingest_floor = get_ingest_floor()
+    if ingest_floor is not None:
+        gaps = [(gap_start, min(gap_end, ingest_floor - 1)) for gap_start, gap_end in gaps if gap_start < ingest_floor]
+    
+    if gaps:
+        logging.info(f'Period {start_time}-{end_time} has {len(gaps)} uncovered gap(s): {gaps}')
+        inc_counter('pbx_cache_lookups_total', result='miss')
+    else:
+        logging.info(f'Using cached data for period {start_time}-{end_time}')
+        inc_counter('pbx_cache_lookups_total', result='hit')
+    
+    settled_before = int(time.time()) - CACHE_SETTLE_SECONDS
+    for gap_start, gap_end in gaps:
+        # Хвосты "до текущего момента" у одновременных запросов отличаются на секунды - считаем их одним
+        flight_key = f"{gap_start}:{'tail' if gap_end >= settled_before else gap_end}"
+        try:
+            error = single_flight(flight_key, lambda: fetch_calls_range(gap_start, gap_end, trunks_dict),
+                                  lambda: is_gap_fetched(gap_start, gap_end))
+        except TimeoutError as e:
+            logging.error(str(e))
+            error = 'Превышено время ожидания загрузки данных другим процессом.'
+        if error:
+            break
+    
+    return error
+
+def is_gap_fetched(gap_start, gap_end):
+    """Загрузил ли участок кто-то другой: проверяем покрытие той части, которую можно покрыть.
+    Свежий хвост в покрытие не попадает, он догружается при следующем запросе"""
+    covered_end = min(gap_end, int(time.time()) - CACHE_SETTLE_SECONDS)
+    return covered_end < gap_start or is_period_cached(gap_start, covered_end)
+
+def get_ingest_floor():
+    """Нижняя граница периода, за который отвечает фоновая загрузка (None, если она не работает)"""
+    state = get_ingest_state()
+    last_success = state.get('last_success')
+    if last_success is None or int(time.time()) - last_success > INGEST_STALE_SECONDS:
+        return None
+    return state.get('floor')
+
+def update_daily_stats_for_day(day, force=False):
+    """Пересчитывает статистику по номерам за день из локального кеша"""
+    start_of_day = datetime.combine(day, datetime.min.time())
+    end_of_day = datetime.combine(day, datetime.max.time())
+    start_time = int(start_of_day.timestamp())
+    end_time = min(int(end_of_day.timestamp()), int(time.time()))
+    
+    caller_stats = get_caller_stats(start_time, end_time)
+    save_daily_stats(caller_stats, start_time, end_time, day.strftime('%Y-%m-%d'), force=force)
+
+def ingest_once():
+    """Один проход фоновой загрузки: забирает звонки начиная с high-water mark"""
+    from datetime import timedelta
+    now = int(time.time())
+    state = get_ingest_state()
+    high_water = state.get('high_water')
+    
+    if high_water is None:
+        # Первый запуск - начинаем с начала сегодняшнего дня
+        high_water = int(datetime.combine(datetime.now().date(), datetime.min.time()).timestamp())
+        set_ingest_state(floor=high_water)
+    
+    logging.info(f'Ingesting calls from high-water mark {high_water} to {now}')
+    trunks_dict = get_trunks_data()
+    error = fetch_calls_range(high_water, now, trunks_dict)
+    if error:
+        logging.error(f'Ingestion failed: {error}')
+        return False
+    
+    # Пересчитываем статистику за затронутые дни (в т.ч. закрываем вчерашний день после полуночи)
+    day = datetime.fromtimestamp(high_water).date()
+    while day <= datetime.fromtimestamp(now).date():
+        update_daily_stats_for_day(day, force=True)
+        day += timedelta(days=1)
+    
+    # Свежий хвост перезапрашиваем на следующем проходе, пока звонки в нём не устоятся
+    set_ingest_state(high_water=max(high_water, now - CACHE_SETTLE_SECONDS), last_success=now)
+    return True
+
+def run_ingestion_loop(stop_event=None):
+    """Цикл фоновой загрузки. Загружает только тот процесс, который держит аренду 'ingest'"""
+    stop_event = stop_event or threading.Event()
+    owner = f"ingest:{os.getpid()}"
+    logging.info(f'Ingestion loop started (interval {INGEST_INTERVAL}s, owner {owner})')
+    
+    while not stop_event.is_set():
+        try:
+            if acquire_lease('ingest', INGEST_INTERVAL * 3, owner=owner):
+                ingest_once()
+        except Exception as e:
+            logging.error(f'Error in ingestion loop: {e}')
+        stop_event.wait(INGEST_INTERVAL)
+
+def backfill_history(date_from, date_to, workers=4, chunk='day'):
+    """Параллельно загружает историю за диапазон дат кусками по дню или часу.
+    Уже покрытые куски пропускаются, поэтому прерванную загрузку можно просто запустить снова"""
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    from datetime import timedelta
+    
+    chunk_seconds = 3600 if chunk == 'hour' else 86400
+    range_start = int(datetime.combine(date_from, datetime.min.time()).timestamp())
+    range_end = min(int(datetime.combine(date_to, datetime.max.time()).timestamp()), int(time.time()))
+    
+    # Куски, которых ещё нет в кеше (это и есть контрольные точки прошлых запусков)
+    chunks = []
+    chunk_start = range_start
+    while chunk_start <= range_end:
+        chunk_end = min(chunk_start + chunk_seconds - 1, range_end)
+        if not is_period_cached(chunk_start, chunk_end):
+            chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end + 1
+    
+    logging.info(f'Backfill {date_from}..{date_to}: {len(chunks)} chunk(s) to fetch, {workers} worker(s)')
+    started = time.time()
+    trunks_dict = get_trunks_data()
+    done = 0
+    failed_days = set()
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(fetch_calls_from_api, s, e, trunks_dict): (s, e) for s, e in chunks}
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                chunk_start, chunk_end = pending.pop(future)
+                error, truncated = future.result()
+                if error:
+                    logging.error(f'Backfill chunk {chunk_start}-{chunk_end} failed: {error}')
+                    failed_days.add(datetime.fromtimestamp(chunk_start).date())
+                elif truncated and chunk_end - chunk_start + 1 > MIN_SPLIT_SECONDS:
+                    # Ответ обрезан - делим кусок и ставим половинки в очередь
+                    for part_start, part_end in split_period(chunk_start, chunk_end):
+                        pending[executor.submit(fetch_calls_from_api, part_start, part_end, trunks_dict)] = (part_start, part_end)
+                else:
+                    done += 1
+    
+    # Пересчитываем дневную статистику по загруженным дням
+    day = date_from
+    while day <= min(date_to, datetime.now().date()):
+        if day not in failed_days:
+            update_daily_stats_for_day(day, force=True)
+        day += timedelta(days=1)
+    
+    logging.info(f'Backfill finished in {time.time() - started:.1f}s: {done} chunk(s) done, failed days: {sorted(failed_days)}')
+    return not failed_days
+
+def iter_file_text(path, chunk_size=65536):
+    """Читает текстовый файл кусками"""
+    with open(path, encoding='utf-8') as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+def iter_dump_calls(path, file_format='auto'):
+    """Потоково отдаёт звонки из дампа: JSON-массив, сохранённый ответ API ({"data": [...]}) или JSONL"""
+    if file_format == 'auto':
+        file_format = 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'json'
+    
+    if file_format == 'jsonl':
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        return
+    
+    chunks = iter_file_text(path)
+    first = next(chunks, '')
+    key = 'data' if first.lstrip().startswith('{') else None
+    yield from iter_json_array(itertools.chain([first], chunks), key=key)
+
+def import_calls(path, file_format='auto'):
+    """Загружает исходящие звонки из дампа в кеш без обращения к API и пересчитывает статистику затронутых дней.
+    Покрытие периодов не отмечается: дамп не гарантирует, что в нём есть все звонки периода.
+    Номера, которых нет в кеше trunk'ов, добавляются туда с описанием из дампа"""
+    # Описания номеров берём из кеша независимо от возраста, чтобы не ходить в API
+    trunks_dict = {trunk.get('number'): trunk.get('description', '')
+                   for trunk in get_trunks_from_cache(max_age_seconds=10 * 365 * 86400) or []}
+    dump_descriptions = {}
+    days = set()
+    
+    def iter_calls():
+        for call in iter_dump_calls(path, file_format):
+            # Как и при загрузке из API, храним только исходящие звонки
+            if call.get('accountcode') != 'outbound':
+                continue
+            # Поле, которое старые версии добавляли при выводе на страницу
+            call.pop('formatted_start_stamp', None)
+            dump_description = call.get('description') or ''
+            call = normalize_call(call, trunks_dict)
+            number = call['caller_id_number']
+            if number not in trunks_dict:
+                # Номер неизвестен (например, новый экземпляр без trunk'ов) - оставляем описание из дампа
+                call['description'] = dump_description
+                if dump_description:
+                    dump_descriptions[number] = dump_description
+            days.add(datetime.fromtimestamp(call.get('start_stamp', 0)).date())
+            yield call
+    
+    started = time.perf_counter()
+    saved = save_calls_to_cache(iter_calls(), 0, 0, mark_covered=False)
+    saved_seconds = time.perf_counter() - started
+    
+    # Статистика берёт описания из trunks: без этого дни из дампа остались бы без описаний навсегда.
+    # Следующее обновление trunk'ов из API заменит эти записи полными данными
+    if dump_descriptions:
+        save_trunks_to_cache([{'number': number, 'description': description}
+                              for number, description in dump_descriptions.items()])
+        logging.info(f'Added {len(dump_descriptions)} trunk description(s) from the dump')
+    
+    for day in sorted(days):
+        update_daily_stats_for_day(day, force=True)
+    
+    elapsed = time.perf_counter() - started
+    rate = saved / saved_seconds if saved_seconds > 0 else 0
+    logging.info(f'Imported {saved} calls from {path} in {elapsed:.1f}s '
+                 f'({rate:.0f} calls/s including parsing), rebuilt stats for {len(days)} day(s)')
+    return saved
+
+_ingestion_pid = None
+
+def start_ingestion_worker():
+    """Запускает фоновый поток загрузки (один раз на процесс)"""
+    global _ingestion_pid
+    if _ingestion_pid == os.getpid():
+        return
+    _ingestion_pid = os.getpid()
+    thread = threading.Thread(target=run_ingestion_loop, name='pbx-ingest', daemon=True)
+    thread.start()
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def observe_render_time(sender, template, context, **extra):
+    started = g.pop('render_started', None)
+    if started is not None:
+        observe('pbx_stage_seconds', time.perf_counter() - started, stage=f'render:{template.name}')
+
+# Код приложения и шаблонов входит в ETag, чтобы после обновления браузеры не получали 304 на старую вёрстку
+_app_dir = os.path.dirname(os.path.abspath(__file__))
+RESPONSE_ETAG_SALT = hashlib.md5(repr(sorted(
+    (name, os.path.getmtime(os.path.join(_app_dir, name)))
+    for name in ['app.py'] + [os.path.join('templates', t) for t in os.listdir(os.path.join(_app_dir, 'templates'))]
+)).encode()).hexdigest()[:8]
+
+_day_responses = OrderedDict()
+_day_responses_lock = threading.Lock()
+
+def get_day_etag(date_str):
+    """ETag страницы дня: версии данных дня и справочника номеров"""
+    day_version, trunks_version = get_data_versions(date_str, 'trunks')
+    return f'{date_str}.{day_version}.{trunks_version}.{RESPONSE_ETAG_SALT}'
+
+def make_day_response(body, etag, cache_control):
+    """HTML-ответ с ETag и Cache-Control; при совпадении If-None-Match - 304"""
+    from flask import request
+    response = Response(body, mimetype='text/html')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response.make_conditional(request)
+
+def cached_day_response(date_str, render, cache_control, period=None):
+    """Страница закрытого дня из кеша отрендеренных ответов.
+    render() возвращает (html, complete): неполные страницы (ошибка загрузки) не кешируются.
+    period - (start, end) дня: пока он не покрыт кешем звонков, страница рендерится заново
+    и отдаётся с no-cache вместо cache_control"""
+    from flask import request
+    if date_str >= datetime.now().strftime('%Y-%m-%d'):
+        body, _ = render()
+        return body
+    
+    if period is None or is_period_cached(*period):
+        etag = get_day_etag(date_str)
+        if request.if_none_match.contains(etag):
+            inc_counter('pbx_day_response_cache_total', result='not_modified')
+            return make_day_response(b'', etag, cache_control)
+        with _day_responses_lock:
+            body = _day_responses.get((request.path, etag))
+            if body is not None:
+                _day_responses.move_to_end((request.path, etag))
+        if body is not None:
+            inc_counter('pbx_day_response_cache_total', result='hit')
+            return make_day_response(body, etag, cache_control)
+    
+    body, complete = render()
+    if not complete:
+        return body
+    
+    # Версия читается после рендера: он мог догрузить недостающие звонки
+    etag = get_day_etag(date_str)
+    if period is not None and not is_period_cached(*period):
+        # День так и не покрыт целиком (свежий хвост после полуночи, чужая загрузка не удалась):
+        # такую страницу не кешируем ни у себя, ни в браузере - только проверка по ETag
+        inc_counter('pbx_day_response_cache_total', result='incomplete')
+        return make_day_response(body, etag, RELATIVE_DAY_CACHE_CONTROL)
+    inc_counter('pbx_day_response_cache_total', result='miss')
+    with _day_responses_lock:
+        _day_responses[(request.path, etag)] = body
+        while len(_day_responses) > DAY_RESPONSE_CACHE_SIZE:
+            _day_responses.popitem(last=False)
+    return make_day_response(body, etag, cache_control)
+
+@app.route('/metrics')
+def metrics():
+    """Метрики в текстовом формате Prometheus (по текущему воркеру)"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.before_request
+def ensure_ingestion_worker():
+    """Поток запускается в воркере при первом запросе, а не в мастер-процессе до fork"""
+    if INGEST_ENABLED:
+        start_ingestion_worker()
+
+def get_calls_data(interval_seconds, title):
+    """Общая функция для получения данных о звонках за указанный интервал"""
+    logging.info(f'Entering get_calls_data function for {title}')
+    now = int(time.time())
+    start_time = now - interval_seconds
+    period_label = format_period_label(start_time, now)
+    
+    # Получаем данные о trunk'ах для описаний номеров
+    trunks_dict = get_trunks_data()
+    
+    error = ensure_period_cached(start_time, now, trunks_dict)
+    
+    # Вычисляем статистику по номерам звонящих
+    caller_stats = get_caller_stats(start_time, now)
+    
+    # Сами звонки страница подгружает постранично через /api/calls
+    calls_period = {'from': start_time, 'to': now}
+    return calls_period, caller_stats, error, period_label
 
 @app.route('/')
 def index():
     """Главная страница - звонки за последние 10 минут"""
-    calls, caller_stats, error, period_label = get_calls_data(600, "10 минут")
-    return render_template('index.html', calls=calls, caller_stats=caller_stats, error=error, title="Звонки за последние 10 минут", period_label=period_label)
+    calls_period, caller_stats, error, period_label = get_calls_data(600, "10 минут")
+    return render_template('index.html', calls_period=calls_period, caller_stats=caller_stats, error=error, title="Звонки за последние 10 минут", period_label=period_label)
 
 @app.route('/1h')
 def calls_1h():
     """Звонки за последний час"""
-    calls, caller_stats, error, period_label = get_calls_data(3600, "1 час")
-    return render_template('index.html', calls=calls, caller_stats=caller_stats, error=error, title="Звонки за последний час", period_label=period_label)
+    calls_period, caller_stats, error, period_label = get_calls_data(3600, "1 час")
+    return render_template('index.html', calls_period=calls_period, caller_stats=caller_stats, error=error, title="Звонки за последний час", period_label=period_label)
 
 @app.route('/4h')
 def calls_4h():
     """Звонки за последние 4 часа"""
-    calls, caller_stats, error, period_label = get_calls_data(14400, "4 часа")
-    return render_template('index.html', calls=calls, caller_stats=caller_stats, error=error, title="Звонки за последние 4 часа", period_label=period_label)
+    calls_period, caller_stats, error, period_label = get_calls_data(14400, "4 часа")
+    return render_template('index.html', calls_period=calls_period, caller_stats=caller_stats, error=error, title="Звонки за последние 4 часа", period_label=period_label)
 
 @app.route('/8h')
 def calls_8h():
     """Звонки за последние 8 часов"""
-    calls, caller_stats, error, period_label = get_calls_data(28800, "8 часов")
-    return render_template('index.html', calls=calls, caller_stats=caller_stats, error=error, title="Звонки за последние 8 часов", period_label=period_label)
+    calls_period, caller_stats, error, period_label = get_calls_data(28800, "8 часов")
+    return render_template('index.html', calls_period=calls_period, caller_stats=caller_stats, error=error, title="Звонки за последние 8 часов", period_label=period_label)
 
 @app.route('/today')
 def calls_today():
@@ -1012,8 +2223,10 @@ def calls_today():
     date_str_db = now.strftime('%Y-%m-%d')
     
     # Используем функцию с фиксированными временными метками для сохранения статистики
-    calls, caller_stats, error, period_label = get_calls_data_for_period(start_time, end_time, f"сегодня ({date_str_display})", date_str_db)
-    return render_template('index.html', calls=calls, caller_stats=caller_stats, error=error, title=f"Звонки за сегодня ({date_str_display})", period_label=period_label)
+    calls_period, caller_stats, error, period_label = get_calls_data_for_period(start_time, end_time, f"сегодня ({date_str_display})", date_str_db)
+    # Дальше страница обновляется сама через /api/live
+    live_since = get_last_call_rowid()
+    return render_template('index.html', calls_period=calls_period, caller_stats=caller_stats, error=error, title=f"Звонки за сегодня ({date_str_display})", period_label=period_label, live_since=live_since, live_day=date_str_db, live_poll_ms=int(LIVE_POLL_INTERVAL * 1000))
 
 def get_calls_data_for_period(start_time, end_time, title, date_str=None):
     """Общая функция для получения данных о звонках за указанный период с фиксированными временными метками"""
@@ -1023,104 +2236,23 @@ def get_calls_data_for_period(start_time, end_time, title, date_str=None):
     if not date_str:
         date_str = datetime.fromtimestamp(start_time).strftime('%Y-%m-%d')
     
-    payload = {
-        'start_stamp_from': start_time,
-        'start_stamp_to': end_time
-    }
-    calls = []
-    error = None
     period_label = format_period_label(start_time, end_time)
     
     # Получаем данные о trunk'ах для описаний номеров
     trunks_dict = get_trunks_data()
     
-    # Проверяем, есть ли данные в кеше
-    if is_period_cached(start_time, end_time):
-        logging.info(f'Using cached data for period {start_time}-{end_time}')
-        calls = get_calls_from_cache(start_time, end_time)
-        
-        # Добавляем форматированные поля и описания
-        for call in calls:
-            call['formatted_start_stamp'] = format_timestamp(call.get('start_stamp', 0))
-            caller_number = call.get('caller_id_number', '')
-            call['description'] = trunks_dict.get(caller_number, '')
-        
-        # Вычисляем статистику по номерам звонящих
-        caller_stats = calculate_caller_stats(calls)
-        
-        # Сохраняем статистику в БД (если её ещё нет)
-        logging.info(f'Calling save_daily_stats for date {date_str} (from cache)')
-        save_daily_stats(caller_stats, start_time, end_time, date_str)
-        
-        return calls, caller_stats, error, period_label
+    error = ensure_period_cached(start_time, end_time, trunks_dict)
     
-    # Если нет в кеше, запрашиваем из API
-    logging.info(f'Fetching data from API for period {start_time}-{end_time}')
-    for attempt in range(2):  # максимум 2 попытки: с текущим ключом и с новым
-        api_key = get_valid_api_key()
-        if not api_key:
-            error = 'Не удалось получить API-ключ для авторизации.'
-            logging.error(error)
-            break
-        headers = {
-            'x-pbx-authentication': api_key,
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
-        try:
-            response = requests.post(API_URL, data=payload, headers=headers, timeout=10)
-            response.raise_for_status()
-            logging.info(f"API Response Status Code: {response.status_code}")
-            logging.info(f"API Response Body: {response.text}")
-            data = response.json()
-            logging.info(f"Parsed JSON data: {json.dumps(data, indent=2, ensure_ascii=False)}")
-            if data.get('isNotAuth'):
-                logging.warning('API key expired or invalid, requesting new key...')
-                get_new_api_key()
-                continue  # повторить запрос с новым ключом
-            all_calls = data.get('data', [])
-            # Фильтруем только исходящие звонки (accountcode = 'outbound')
-            calls = [call for call in all_calls if call.get('accountcode') == 'outbound']
-            # Сортируем звонки от новых к старым (по убыванию start_stamp)
-            calls.sort(key=lambda call: call.get('start_stamp', 0), reverse=True)
-            for call in calls:
-                call['caller_id_number'] = call.get('gateway') or call.get('caller_id_number') or call.get('caller_id_name')
-                call['billsec'] = call.get('billsec', call.get('duration', 0))
-                call['formatted_start_stamp'] = format_timestamp(call.get('start_stamp', 0))
-                # Добавляем описание номера из данных о trunk'ах
-                caller_number = call['caller_id_number']
-                call['description'] = trunks_dict.get(caller_number, '')
-            
-            # Сохраняем полученные данные в кеш
-            save_calls_to_cache(calls, start_time, end_time)
-            
-            # Вычисляем статистику по номерам звонящих
-            caller_stats = calculate_caller_stats(calls)
-            
-            # Сохраняем статистику в БД
-            save_daily_stats(caller_stats, start_time, end_time, date_str)
-            
-            break  # успешный запрос, выходим из цикла
-        except requests.exceptions.Timeout:
-            error = 'Превышено время ожидания ответа от API.'
-            logging.error(error)
-            break
-        except requests.exceptions.RequestException as e:
-            if '403' in str(e):
-                logging.warning('API key expired (403 Forbidden), requesting new key...')
-                get_new_api_key()
-                continue  # повторить запрос с новым ключом
-            error = f'Ошибка запроса к API: {e}'
-            logging.error(error)
-            break
-        except Exception as e:
-            error = f'Непредвиденная ошибка: {e}'
-            logging.error(error)
-            break
-    # Инициализируем статистику если не была вычислена
-    if 'caller_stats' not in locals():
-        caller_stats = []
+    # Вычисляем статистику по номерам звонящих
+    caller_stats = get_caller_stats(start_time, end_time)
+    
+    # Сохраняем статистику в БД только по полным данным
+    if not error:
+        logging.info(f'Calling save_daily_stats for date {date_str}')
+        save_daily_stats(caller_stats, start_time, end_time, date_str)
     
-    return calls, caller_stats, error, period_label
+    calls_period = {'from': start_time, 'to': end_time}
+    return calls_period, caller_stats, error, period_label
 
 def get_calls_data_with_offset(interval_seconds, title, offset_seconds=0):
     """Общая функция для получения данных о звонках за указанный интервал с возможным смещением"""
@@ -1128,99 +2260,18 @@ def get_calls_data_with_offset(interval_seconds, title, offset_seconds=0):
     now = int(time.time())
     end_time = now - offset_seconds
     start_time = end_time - interval_seconds
-    payload = {
-        'start_stamp_from': start_time,
-        'start_stamp_to': end_time
-    }
-    calls = []
-    error = None
     period_label = format_period_label(start_time, end_time)
     
     # Получаем данные о trunk'ах для описаний номеров
     trunks_dict = get_trunks_data()
     
-    # Проверяем, есть ли данные в кеше
-    if is_period_cached(start_time, end_time):
-        logging.info(f'Using cached data for period {start_time}-{end_time}')
-        calls = get_calls_from_cache(start_time, end_time)
-        
-        # Добавляем форматированные поля и описания
-        for call in calls:
-            call['formatted_start_stamp'] = format_timestamp(call.get('start_stamp', 0))
-            caller_number = call.get('caller_id_number', '')
-            call['description'] = trunks_dict.get(caller_number, '')
-        
-        # Вычисляем статистику по номерам звонящих
-        caller_stats = calculate_caller_stats(calls)
-        return calls, caller_stats, error, period_label
+    error = ensure_period_cached(start_time, end_time, trunks_dict)
     
-    # Если нет в кеше, запрашиваем из API
-    logging.info(f'Fetching data from API for period {start_time}-{end_time}')
-    for attempt in range(2):  # максимум 2 попытки: с текущим ключом и с новым
-        api_key = get_valid_api_key()
-        if not api_key:
-            error = 'Не удалось получить API-ключ для авторизации.'
-            logging.error(error)
-            break
-        headers = {
-            'x-pbx-authentication': api_key,
-            'Content-Type': 'application/x-www-form-urlencoded'
-        }
-        try:
-            response = requests.post(API_URL, data=payload, headers=headers, timeout=10)
-            response.raise_for_status()
-            logging.info(f"API Response Status Code: {response.status_code}")
-            logging.info(f"API Response Body: {response.text}")
-            data = response.json()
-            logging.info(f"Parsed JSON data: {json.dumps(data, indent=2, ensure_ascii=False)}")
-            if data.get('isNotAuth'):
-                logging.warning('API key expired or invalid, requesting new key...')
-                get_new_api_key()
-                continue  # повторить запрос с новым ключом
-            all_calls = data.get('data', [])
-            # Фильтруем только исходящие звонки (accountcode = 'outbound')
-            calls = [call for call in all_calls if call.get('accountcode') == 'outbound']
-            # Сортируем звонки от новых к старым (по убыванию start_stamp)
-            calls.sort(key=lambda call: call.get('start_stamp', 0), reverse=True)
-            for call in calls:
-                call['caller_id_number'] = call.get('gateway') or call.get('caller_id_number') or call.get('caller_id_name')
-                call['billsec'] = call.get('billsec', call.get('duration', 0))
-                call['formatted_start_stamp'] = format_timestamp(call.get('start_stamp', 0))
-                # Добавляем описание номера из данных о trunk'ах
-                caller_number = call['caller_id_number']
-                call['description'] = trunks_dict.get(caller_number, '')
-            
-            # Сохраняем полученные данные в кеш
-            save_calls_to_cache(calls, start_time, end_time)
-            
-            # Вычисляем статистику по номерам звонящих
-            caller_stats = calculate_caller_stats(calls)
-            
-            # Сохраняем статистику в БД
-            save_daily_stats(caller_stats, start_time, end_time, date_str)
-            
-            break  # успешный запрос, выходим из цикла
-        except requests.exceptions.Timeout:
-            error = 'Превышено время ожидания ответа от API.'
-            logging.error(error)
-            break
-        except requests.exceptions.RequestException as e:
-            if '403' in str(e):
-                logging.warning('API key expired (403 Forbidden), requesting new key...')
-                get_new_api_key()
-                continue  # повторить запрос с новым ключом
-            error = f'Ошибка запроса к API: {e}'
-            logging.error(error)
-            break
-        except Exception as e:
-            error = f'Непредвиденная ошибка: {e}'
-            logging.error(error)
-            break
-    # Инициализируем статистику если не была вычислена
-    if 'caller_stats' not in locals():
-        caller_stats = []
+    # Вычисляем статистику по номерам звонящих
+    caller_stats = get_caller_stats(start_time, end_time)
     
-    return calls, caller_stats, error, period_label
+    calls_period = {'from': start_time, 'to': end_time}
+    return calls_period, caller_stats, error, period_label
 
 @app.route('/yesterday')
 def calls_yesterday():
@@ -1235,9 +2286,12 @@ def calls_yesterday():
     date_str_display = yesterday.strftime('%d.%m.%Y')
     date_str_db = yesterday.strftime('%Y-%m-%d')
     
-    # Вызываем функцию с фиксированными временными метками
-    calls, caller_stats, error, period_label = get_calls_data_for_period(start_time, end_time, f"вчера ({date_str_display})", date_str_db)
-    return render_template('index.html', calls=calls, caller_stats=caller_stats, error=error, title=f"Звонки за вчера ({date_str_display})", period_label=period_label)
+    def render():
+        # Вызываем функцию с фиксированными временными метками
+        calls_period, caller_stats, error, period_label = get_calls_data_for_period(start_time, end_time, f"вчера ({date_str_display})", date_str_db)
+        return render_template('index.html', calls_period=calls_period, caller_stats=caller_stats, error=error, title=f"Звонки за вчера ({date_str_display})", period_label=period_label), error is None
+    
+    return cached_day_response(date_str_db, render, RELATIVE_DAY_CACHE_CONTROL, (start_time, end_time))
 
 @app.route('/day_before_yesterday')
 def calls_day_before_yesterday():
@@ -1252,9 +2306,12 @@ def calls_day_before_yesterday():
     date_str_display = day_before_yesterday.strftime('%d.%m.%Y')
     date_str_db = day_before_yesterday.strftime('%Y-%m-%d')
     
-    # Вызываем функцию с фиксированными временными метками
-    calls, caller_stats, error, period_label = get_calls_data_for_period(start_time, end_time, f"позавчера ({date_str_display})", date_str_db)
-    return render_template('index.html', calls=calls, caller_stats=caller_stats, error=error, title=f"Звонки за позавчера ({date_str_display})", period_label=period_label)
+    def render():
+        # Вызываем функцию с фиксированными временными метками
+        calls_period, caller_stats, error, period_label = get_calls_data_for_period(start_time, end_time, f"позавчера ({date_str_display})", date_str_db)
+        return render_template('index.html', calls_period=calls_period, caller_stats=caller_stats, error=error, title=f"Звонки за позавчера ({date_str_display})", period_label=period_label), error is None
+    
+    return cached_day_response(date_str_db, render, RELATIVE_DAY_CACHE_CONTROL, (start_time, end_time))
 
 @app.route('/date/<date_str>')
 def calls_by_date(date_str):
@@ -1268,7 +2325,7 @@ def calls_by_date(date_str):
         today = datetime.now().date()
         if date_obj.date() > today:
             return render_template('index.html', 
-                                 calls=[], 
+                                 calls_period=None, 
                                  caller_stats=[], 
                                  error='Нельзя выбрать дату в будущем', 
                                  title="Ошибка", 
@@ -1282,17 +2339,20 @@ def calls_by_date(date_str):
         
         date_str_display = date_obj.strftime('%d.%m.%Y')
         
-        # Вызываем функцию с фиксированными временными метками
-        calls, caller_stats, error, period_label = get_calls_data_for_period(start_time, end_time, f"за {date_str_display}", date_str)
-        return render_template('index.html', 
-                             calls=calls, 
-                             caller_stats=caller_stats, 
-                             error=error, 
-                             title=f"Звонки за {date_str_display}", 
-                             period_label=period_label)
+        def render():
+            # Вызываем функцию с фиксированными временными метками
+            calls_period, caller_stats, error, period_label = get_calls_data_for_period(start_time, end_time, f"за {date_str_display}", date_str)
+            return render_template('index.html', 
+                                 calls_period=calls_period, 
+                                 caller_stats=caller_stats, 
+                                 error=error, 
+                                 title=f"Звонки за {date_str_display}", 
+                                 period_label=period_label), error is None
+        
+        return cached_day_response(date_str, render, CLOSED_DAY_CACHE_CONTROL, (start_time, end_time))
     except ValueError:
         return render_template('index.html', 
-                             calls=[], 
+                             calls_period=None, 
                              caller_stats=[], 
                              error='Неверный формат даты. Используйте формат YYYY-MM-DD', 
                              title="Ошибка", 
@@ -1300,7 +2360,7 @@ def calls_by_date(date_str):
     except Exception as e:
         logging.error(f'Error in calls_by_date: {e}')
         return render_template('index.html', 
-                             calls=[], 
+                             calls_period=None, 
                              caller_stats=[], 
                              error=f'Ошибка: {e}', 
                              title="Ошибка", 
@@ -1326,11 +2386,8 @@ def trunks():
             'Content-Type': 'application/x-www-form-urlencoded'
         }
         
-        # URL для получения статуса номеров
-        trunks_url = f'https://api2.onlinepbx.ru/{DOMAIN}/trunks/get.json'
-        
         try:
-            response = requests.post(trunks_url, headers=headers, timeout=10)
+            response = pbx_post('trunks', TRUNKS_URL, headers=headers)
             response.raise_for_status()
             logging.info(f"Trunks API Response Status Code: {response.status_code}")
             logging.info(f"Trunks API Response Body: {response.text}")
@@ -1340,7 +2397,7 @@ def trunks():
             
             if data.get('isNotAuth'):
                 logging.warning('API key expired or invalid, requesting new key...')
-                get_new_api_key()
+                refresh_api_key(api_key)
                 continue  # повторить запрос с новым ключом
             
             if data.get('status') == '1':
@@ -1358,7 +2415,7 @@ def trunks():
         except requests.exceptions.RequestException as e:
             if '403' in str(e):
                 logging.warning('API key expired (403 Forbidden), requesting new key...')
-                get_new_api_key()
+                refresh_api_key(api_key)
                 continue  # повторить запрос с новым ключом
             error = f'Ошибка запроса к API: {e}'
             logging.error(error)
@@ -1372,11 +2429,11 @@ def trunks():
 
 @app.route('/stats')
 def stats_page():
-    """Страница статистики по дням или по неделям"""
+    """Страница статистики по дням, неделям или месяцам"""
     from flask import request
     logging.info('Entering stats_page function')
     
-    # Получаем режим отображения (daily или weekly)
+    # Получаем режим отображения (daily, weekly или monthly)
     mode = request.args.get('mode', 'daily')
     
     # Получаем список всех дат со статистикой
@@ -1388,32 +2445,23 @@ def stats_page():
         stat['date_display'] = date_obj.strftime('%d.%m.%Y')
         stat['period_label'] = format_period_label(stat['start_stamp'], stat['end_stamp'])
     
-    if mode == 'weekly':
-        # Получаем недельную статистику
-        comprehensive_stats, weekly_periods = get_comprehensive_stats_weekly()
+    if mode in ('weekly', 'monthly'):
+        # Получаем недельную или месячную статистику
+        if mode == 'weekly':
+            comprehensive_stats, weekly_periods = get_comprehensive_stats_weekly()
+        else:
+            comprehensive_stats, weekly_periods = get_comprehensive_stats_monthly()
         
         return render_template('stats.html', 
                              stats_dates=stats_dates, 
                              comprehensive_stats=comprehensive_stats,
                              weekly_periods=weekly_periods,
-                             mode='weekly')
+                             mode=mode)
     else:
-        # Получаем дневную статистику (по умолчанию)
-        comprehensive_stats, dates = get_comprehensive_stats()
-        
-        # Форматируем даты для заголовков таблицы
-        formatted_dates = []
-        for date in dates:
-            date_obj = datetime.strptime(date, '%Y-%m-%d')
-            formatted_dates.append({
-                'date': date,
-                'display': date_obj.strftime('%d.%m')
-            })
-        
+        # Дневная таблица подгружается страницей по колонкам через /api/stats/matrix
         return render_template('stats.html', 
                              stats_dates=stats_dates, 
-                             comprehensive_stats=comprehensive_stats,
-                             formatted_dates=formatted_dates,
+                             matrix_columns=STATS_MATRIX_COLUMNS,
                              mode='daily')
 
 @app.route('/stats/<date>')
@@ -1425,26 +2473,140 @@ def stats_detail(date):
         # Проверяем формат даты (YYYY-MM-DD)
         date_obj = datetime.strptime(date, '%Y-%m-%d')
         date_display = date_obj.strftime('%d.%m.%Y')
+        start_time = int(date_obj.timestamp())
+        end_time = start_time + 86399
         
-        # Получаем статистику за этот день
-        caller_stats = get_daily_stats_by_date(date)
-        
-        # Вычисляем общую статистику
-        total_calls = sum(stat['total_calls'] for stat in caller_stats)
-        total_calls_over_45s = sum(stat['calls_over_45s'] for stat in caller_stats)
+        def render():
+            # Получаем статистику за этот день
+            caller_stats = get_daily_stats_by_date(date)
+            
+            # Вычисляем общую статистику
+            total_calls = sum(stat['total_calls'] for stat in caller_stats)
+            total_calls_over_45s = sum(stat['calls_over_45s'] for stat in caller_stats)
+            
+            return render_template('stats_detail.html', 
+                                 date=date, 
+                                 date_display=date_display,
+                                 caller_stats=caller_stats,
+                                 total_calls=total_calls,
+                                 total_calls_over_45s=total_calls_over_45s), True
         
-        return render_template('stats_detail.html', 
-                             date=date, 
-                             date_display=date_display,
-                             caller_stats=caller_stats,
-                             total_calls=total_calls,
-                             total_calls_over_45s=total_calls_over_45s)
+        # Статистика дня полна, только если звонки дня целиком в кеше
+        return cached_day_response(date, render, CLOSED_DAY_CACHE_CONTROL, (start_time, end_time))
     except ValueError:
         return "Неверный формат даты", 400
     except Exception as e:
         logging.error(f'Error in stats_detail: {e}')
         return f"Ошибка: {e}", 500
 
+def iter_query_batches(query, params):
+    """Результат запроса пачками по EXPORT_FETCH_SIZE строк, без чтения всего результата в память"""
+    cursor = get_db().cursor()
+    cursor.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+        if not rows:
+            return
+        yield rows
+
+def iter_export_chunks(batches, columns, file_format):
+    """Текст выгрузки по пачкам строк: CSV с заголовком или NDJSON"""
+    if file_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        # BOM, чтобы Excel открыл кириллицу в UTF-8
+        yield '\ufeff' + buffer.getvalue()
+        for rows in batches:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(rows)
+            yield buffer.getvalue()
+    else:
+        for rows in batches:
+            yield ''.join(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n' for row in rows)
+
+def iter_gzip(chunks):
+    """Сжимает поток текстовых кусков в gzip на лету"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def parse_export_args():
+    """Параметры выгрузки из запроса: from/to (YYYY-MM-DD, включительно), format (csv|ndjson), gzip (0|1).
+    Возвращает (параметры, ошибка)"""
+    from flask import request
+    try:
+        date_from = datetime.strptime(request.args['from'], '%Y-%m-%d').date()
+        date_to = datetime.strptime(request.args.get('to', request.args['from']), '%Y-%m-%d').date()
+    except (KeyError, ValueError):
+        return None, 'Укажите период в формате from=YYYY-MM-DD&to=YYYY-MM-DD'
+    if date_to < date_from:
+        return None, 'Дата to раньше даты from'
+    
+    file_format = request.args.get('format', 'csv')
+    if file_format not in ('csv', 'ndjson'):
+        return None, 'Поддерживаются форматы csv и ndjson'
+    compress = request.args.get('gzip') == '1'
+    return (date_from, date_to, file_format, compress), None
+
+def export_response(batches, columns, name, file_format, compress):
+    """Потоковый ответ-файл выгрузки"""
+    chunks = iter_export_chunks(batches, columns, file_format)
+    filename = f'{name}.{file_format}'
+    mimetype = 'text/csv' if file_format == 'csv' else 'application/x-ndjson'
+    if compress:
+        chunks = iter_gzip(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    
+    response = Response(chunks, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+@app.route('/export/calls')
+def export_calls():
+    """Выгрузка исходящих звонков за диапазон дат потоком из БД (CSV или NDJSON, опционально gzip)"""
+    params, error = parse_export_args()
+    if error:
+        return jsonify({'error': error}), 400
+    date_from, date_to, file_format, compress = params
+    
+    start_stamp = int(datetime.combine(date_from, datetime.min.time()).timestamp())
+    end_stamp = int(datetime.combine(date_to, datetime.max.time()).timestamp())
+    names = [column for column in CALL_COLUMNS if column != 'description']
+    batches = iter_query_batches(f'''
+        SELECT {', '.join(f'c.{column}' for column in names)}, t.description FROM calls c
+        LEFT JOIN trunks t ON t.number = c.caller_id_number
+        WHERE c.accountcode = 'outbound' AND c.start_stamp >= ? AND c.start_stamp <= ?
+        ORDER BY c.start_stamp, c.id
+    ''', (start_stamp, end_stamp))
+    
+    # Время начала в читаемом виде - первой колонкой
+    start_index = names.index('start_stamp')
+    batches = ([(format_timestamp(row[start_index]),) + row for row in rows] for rows in batches)
+    columns = ['formatted_start_stamp'] + names + ['description']
+    return export_response(batches, columns, f'calls_{date_from}_{date_to}', file_format, compress)
+
+@app.route('/export/daily_stats')
+def export_daily_stats():
+    """Выгрузка дневной статистики по номерам за диапазон дат потоком из БД"""
+    params, error = parse_export_args()
+    if error:
+        return jsonify({'error': error}), 400
+    date_from, date_to, file_format, compress = params
+    
+    columns = ['date', 'caller_number', 'description', 'total_calls', 'calls_over_45s', 'percentage_over_45s']
+    batches = iter_query_batches(f'''
+        SELECT {', '.join(columns)} FROM daily_stats
+        WHERE date >= ? AND date <= ?
+        ORDER BY date, caller_number
+    ''', (date_from.isoformat(), date_to.isoformat()))
+    return export_response(batches, columns, f'daily_stats_{date_from}_{date_to}', file_format, compress)
+
 @app.route('/api/debug')
 def api_debug():
     """Отладочный endpoint для просмотра сырого JSON ответа от PBX API"""
@@ -1465,7 +2627,7 @@ def api_debug():
     }
     
     try:
-        response = requests.post(API_URL, data=payload, headers=headers, timeout=10)
+        response = pbx_post('search', API_URL, data=payload, headers=headers)
         response.raise_for_status()
         
         # Возвращаем и сырой текст, и распарсенный JSON
@@ -1478,12 +2640,190 @@ def api_debug():
     except Exception as e:
         return jsonify({'error': f'Ошибка запроса к API: {e}'}), 500
 
+@app.route('/api/calls')
+def calls_api():
+    """Звонки за период постранично: from/to - Unix timestamp, cursor - из next_cursor прошлой страницы"""
+    from flask import request
+    
+    try:
+        start_stamp = int(request.args['from'])
+        end_stamp = int(request.args['to'])
+        limit = int(request.args.get('limit', CALLS_PAGE_SIZE))
+        cursor = None
+        if request.args.get('cursor'):
+            cursor_stamp, cursor_id = request.args['cursor'].split(':', 1)
+            cursor = (int(cursor_stamp), cursor_id)
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Неверный формат параметров'}), 400
+    limit = max(1, min(limit, CALLS_PAGE_MAX_SIZE))
+    
+    calls, next_cursor = get_calls_page(start_stamp, end_stamp, cursor, limit)
+    return jsonify({
+        'calls': calls,
+        'next_cursor': f'{next_cursor[0]}:{next_cursor[1]}' if next_cursor else None
+    })
+
+def format_sse(event, data, event_id=None):
+    """Одно событие в формате text/event-stream"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, ensure_ascii=False)}')
+    return '\n'.join(lines) + '\n\n'
+
+def get_live_update(after_rowid, start_of_day):
+    """Новые звонки после строки after_rowid и, если они есть, пересчитанная статистика по номерам.
+    Возвращает (звонки, статистика или None, rowid последней просмотренной строки)"""
+    calls, last_rowid = get_new_calls(after_rowid, start_of_day)
+    stats = get_caller_stats(start_of_day, int(time.time())) if calls else None
+    return calls, stats, last_rowid
+
+def get_start_of_today():
+    from datetime import time as day_time
+    return int(datetime.combine(datetime.now().date(), day_time.min).timestamp())
+
+def iter_live_events(after_rowid):
+    """События живой ленты за сегодня: новые звонки и пересчитанная статистика по номерам.
+    Поток закрывается через LIVE_STREAM_SECONDS (браузер переподключится с Last-Event-ID)
+    и при смене дня (страница перезагружается)"""
+    today = datetime.now().date()
+    start_of_day = get_start_of_today()
+    deadline = time.monotonic() + LIVE_STREAM_SECONDS
+    
+    yield f'retry: {int(LIVE_POLL_INTERVAL * 1000)}\n\n'
+    while time.monotonic() < deadline:
+        if datetime.now().date() != today:
+            yield format_sse('reload', {})
+            return
+        
+        calls, stats, last_rowid = get_live_update(after_rowid, start_of_day)
+        if last_rowid != after_rowid:
+            after_rowid = last_rowid
+            if calls:
+                yield format_sse('calls', calls, event_id=after_rowid)
+                yield format_sse('stats', stats)
+                continue
+        
+        # Комментарий держит соединение живым через прокси
+        yield ': ping\n\n'
+        time.sleep(LIVE_POLL_INTERVAL)
+
+# Каждый открытый поток занимает поток воркера на всё время соединения,
+# поэтому их число ограничено: остальные вкладки опрашивают /api/live/poll
+_live_streams = None
+_live_streams_pid = None
+_live_streams_lock = threading.Lock()
+
+def get_live_stream_limit(environ):
+    """Сколько потоков живой ленты может держать воркер при его модели обработки запросов"""
+    if not environ.get('wsgi.multithread'):
+        # sync-воркер обслуживает один запрос за раз: поток ленты занял бы его целиком
+        return 0
+    threads = os.getenv('GUNICORN_THREADS')
+    if threads:
+        # Потоки gthread-воркера (выставляет gunicorn.conf.py): большая часть остаётся обычным запросам
+        return min(LIVE_MAX_STREAMS, int(threads) // 4)
+    return LIVE_MAX_STREAMS
+
+def get_live_streams(environ):
+    """Семафор открытых потоков ленты текущего процесса; создаётся после fork, при первом запросе"""
+    global _live_streams, _live_streams_pid
+    with _live_streams_lock:
+        if _live_streams is None or _live_streams_pid != os.getpid():
+            limit = get_live_stream_limit(environ)
+            _live_streams = threading.BoundedSemaphore(limit)
+            _live_streams_pid = os.getpid()
+            logging.info(f'Live feed streams per worker: {limit}')
+        return _live_streams
+
+@app.route('/api/live')
+def live_feed():
+    """Живая лента /today (Server-Sent Events): новые звонки после since и статистика по номерам.
+    Когда все места для потоков заняты (у sync-воркера их нет), отвечает 503 -
+    страница переходит на опрос /api/live/poll"""
+    from flask import request
+    
+    try:
+        after_rowid = int(request.headers.get('Last-Event-ID') or request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'error': 'Неверный формат параметров'}), 400
+    
+    live_streams = get_live_streams(request.environ)
+    if not live_streams.acquire(blocking=False):
+        inc_counter('pbx_live_streams_total', result='rejected')
+        response = jsonify({'error': 'Слишком много открытых потоков, используйте /api/live/poll'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(int(LIVE_POLL_INTERVAL))
+        return response
+    inc_counter('pbx_live_streams_total', result='opened')
+    
+    response = Response(iter_live_events(after_rowid), mimetype='text/event-stream')
+    # Освобождаем место при закрытии ответа, даже если поток так и не начал отдаваться
+    response.call_on_close(live_streams.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    # Отключаем буферизацию ответа в nginx
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/live/poll')
+def live_poll():
+    """Изменения живой ленты после since одним JSON-ответом - для опроса, когда поток недоступен"""
+    from flask import request
+    
+    try:
+        after_rowid = int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'error': 'Неверный формат параметров'}), 400
+    
+    # Страница открыта вчера - её нужно перезагрузить, как и при событии reload в потоке
+    day = request.args.get('day')
+    if day and day != datetime.now().strftime('%Y-%m-%d'):
+        return jsonify({'reload': True})
+    
+    calls, stats, last_rowid = get_live_update(after_rowid, get_start_of_today())
+    response = jsonify({'calls': calls, 'stats': stats, 'since': last_rowid})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/api/calls/<call_id>')
+def call_details(call_id):
+    """Полные данные одного звонка (с событиями) из кеша"""
+    call = get_call_details(call_id)
+    if call is None:
+        return jsonify({'error': 'Звонок не найден'}), 404
+    return jsonify(call)
+
+@app.route('/api/stats/matrix')
+def stats_matrix():
+    """Колоночная статистика по дням: окно дат, номера и плотные массивы значений"""
+    from flask import request
+    
+    date_from = request.args.get('from')
+    date_to = request.args.get('to')
+    try:
+        for value in (date_from, date_to):
+            if value:
+                datetime.strptime(value, '%Y-%m-%d')
+        limit = int(request.args.get('limit', STATS_MATRIX_COLUMNS))
+    except ValueError:
+        return jsonify({'error': 'Неверный формат параметров'}), 400
+    limit = max(1, min(limit, STATS_MATRIX_MAX_COLUMNS))
+    
+    numbers = [number for number in request.args.get('numbers', '').split(',') if number]
+    return jsonify(get_stats_matrix(date_from, date_to, numbers, limit))
+
+@app.route('/api/debug/http')
+def debug_http():
+    """Отладочный endpoint со статистикой пула соединений к API"""
+    return jsonify(get_http_stats())
+
 @app.route('/api/debug/weekly')
 def debug_weekly():
     """Отладочный endpoint для проверки недельной статистики"""
     from datetime import datetime, timedelta
     
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Получаем все даты из базы
@@ -1507,7 +2847,6 @@ def debug_weekly():
     ''', (week_start.isoformat(), week_end.isoformat()))
     
     data_in_period = cursor.fetchall()
-    conn.close()
     
     return jsonify({
         'today': today.isoformat(),
@@ -1529,8 +2868,47 @@ def debug_weekly():
         'count_in_period': len(data_in_period)
     })
 
-if __name__ == '__main__':
+def main(argv=None):
+    """Точка входа командной строки: запуск веб-сервера, фоновой загрузки или импорта"""
+    import argparse
+    parser = argparse.ArgumentParser(description='PBX calls dashboard')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('serve', help='запустить веб-сервер (по умолчанию)')
+    subparsers.add_parser('ingest', help='запустить только фоновую загрузку звонков из API')
+    
+    parse_date = lambda value: datetime.strptime(value, '%Y-%m-%d').date()
+    backfill_parser = subparsers.add_parser('backfill', help='загрузить историю звонков за диапазон дат')
+    backfill_parser.add_argument('--from', dest='date_from', type=parse_date, required=True, help='YYYY-MM-DD')
+    backfill_parser.add_argument('--to', dest='date_to', type=parse_date, default=datetime.now().date(), help='YYYY-MM-DD')
+    backfill_parser.add_argument('--workers', type=int, default=4)
+    backfill_parser.add_argument('--chunk', choices=['day', 'hour'], default='day')
+    
+    import_parser = subparsers.add_parser('import', help='загрузить звонки из дампа (JSON-массив или JSONL)')
+    import_parser.add_argument('file')
+    import_parser.add_argument('--format', dest='file_format', choices=['auto', 'json', 'jsonl'], default='auto',
+                               help='по умолчанию JSONL для .jsonl/.ndjson, иначе JSON')
+    args = parser.parse_args(argv)
+    
+    if args.command == 'ingest':
+        run_ingestion_loop()
+        return
+    
+    if args.command == 'backfill':
+        ok = backfill_history(args.date_from, args.date_to, workers=args.workers, chunk=args.chunk)
+        raise SystemExit(0 if ok else 1)
+    
+    if args.command == 'import':
+        try:
+            import_calls(args.file, args.file_format)
+        except (OSError, ValueError) as e:
+            logging.error(f'Import of {args.file} failed: {e}')
+            raise SystemExit(1)
+        return
+    
     logging.info("=" * 60)
     logging.info("STARTING FLASK APPLICATION IN DEBUG MODE")
     logging.info("=" * 60)
-    app.run(host='0.0.0.0', port=8000, debug=False) 
\ No newline at end of file
+    app.run(host='0.0.0.0', port=8000, debug=False)
+
+if __name__ == '__main__':
+    main() 
\ No newline at end of file
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Замеры основных путей приложения на синтетических данных: запись в кеш, чтение,
+агрегация статистики и рендеринг страниц.
+
+Каждый набор данных (1k, 50k, 1m звонков) прогоняется в отдельном процессе со своей
+временной БД, к API никто не обращается. Результаты пишутся в JSON для сравнения прогонов:
+    python bench.py --sizes 1k,50k --output bench_results.json
+
+calculate_caller_stats из ранних версий заменена на get_caller_stats (агрегация в SQLite),
+поэтому замеряется она.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from queue import Empty
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Размер набора -> (число звонков, сколько дней истории он покрывает)
+DATASETS = {
+    '1k': (1000, 1),
+    '50k': (50000, 14),
+    '1m': (1000000, 60),
+}
+
+def measure(func, repeat):
+    """Время выполнения func (секунды) за repeat прогонов и результат последнего"""
+    times = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - started)
+    return {
+        'runs': repeat,
+        'min': round(min(times), 6),
+        'median': round(statistics.median(times), 6),
+        'mean': round(statistics.mean(times), 6),
+    }, result
+
+def generate_calls(total, days, end_stamp, seed):
+    """Синтетические исходящие звонки в формате API (тот же генератор, что у fake_pbx)"""
+    import fake_pbx
+    fake_pbx.update_settings({
+        'seed': seed,
+        'calls_per_hour': total / (days * 24),
+        'outbound_share': 1.0,
+        'max_results': total + 1,
+    })
+    start_stamp = end_stamp - days * 86400
+    return fake_pbx.get_trunks(), fake_pbx.iter_calls(start_stamp, end_stamp - 1)
+
+def run_dataset(size, repeat, seed, queue):
+    """Прогон одного набора в отдельном процессе со своей БД"""
+    total, days = DATASETS[size]
+    workdir = tempfile.mkdtemp(prefix=f'pbx-bench-{size}-')
+    os.chdir(workdir)
+    os.environ['INGEST_ENABLED'] = '0'
+    sys.path.insert(0, PROJECT_DIR)
+    logging.disable(logging.INFO)
+
+    import app as pbx
+    from flask import render_template
+
+    results = {}
+    now = int(time.time())
+    today = datetime.now().date()
+    start_of_today = int(datetime.combine(today, datetime.min.time()).timestamp())
+    trunks, _ = generate_calls(total, days, now, seed)
+    pbx.save_trunks_to_cache(trunks)
+    trunks_dict = {trunk['number']: trunk['description'] for trunk in trunks}
+
+    def iter_rows():
+        # Звонки генерируются на лету: миллион словарей в памяти исказил бы замер
+        _, calls = generate_calls(total, days, now, seed)
+        return (pbx.normalize_call(call, trunks_dict) for call in calls)
+
+    # Запись: первая вставка и повторное сохранение тех же звонков (путь "ничего не изменилось").
+    # Время генерации замеряется отдельно и вычитается
+    timing, generated = measure(lambda: sum(1 for _ in iter_rows()), 1)
+    generate_seconds = timing['min']
+    results['generate_calls'] = dict(timing, rows=generated)
+    for name in ('save_calls_to_cache', 'save_calls_to_cache_unchanged'):
+        timing, saved = measure(lambda: pbx.save_calls_to_cache(iter_rows(), now - days * 86400, now), 1)
+        write_seconds = max(timing['min'] - generate_seconds, 1e-9)
+        results[name] = dict(timing, rows=saved, write_seconds=round(write_seconds, 6),
+                             rows_per_second=round(saved / write_seconds))
+
+    # Чтение звонков: последние сутки целиком и первая страница /api/calls
+    timing, day_calls = measure(lambda: pbx.get_calls_from_cache(now - 86400, now), repeat)
+    results['get_calls_from_cache_day'] = dict(timing, rows=len(day_calls))
+    timing, _ = measure(lambda: pbx.get_calls_page(now - 86400, now), repeat)
+    results['get_calls_page'] = timing
+
+    # Статистика по номерам: сегодня (с неполными часами по краям) и вся история
+    timing, today_stats = measure(lambda: pbx.get_caller_stats(start_of_today, now), repeat)
+    results['get_caller_stats_today'] = timing
+    timing, _ = measure(lambda: pbx.get_caller_stats(now - days * 86400, now), repeat)
+    results['get_caller_stats_all'] = timing
+
+    # Дневная статистика по всем дням истории
+    history_days = [today - timedelta(days=offset) for offset in range(days + 1)]
+    timing, _ = measure(lambda: [pbx.update_daily_stats_for_day(day, force=True) for day in history_days], 1)
+    results['save_daily_stats_all_days'] = dict(timing, days=len(history_days))
+    yesterday = today - timedelta(days=1)
+    yesterday_start = int(datetime.combine(yesterday, datetime.min.time()).timestamp())
+    yesterday_stats = pbx.get_caller_stats(yesterday_start, yesterday_start + 86399)
+    timing, _ = measure(lambda: pbx.save_daily_stats(yesterday_stats, yesterday_start, yesterday_start + 86399,
+                                                     yesterday.isoformat(), force=True), repeat)
+    results['save_daily_stats_day'] = timing
+
+    # Сводная статистика
+    timing, _ = measure(pbx.get_comprehensive_stats, repeat)
+    results['get_comprehensive_stats'] = timing
+    timing, _ = measure(lambda: pbx.get_stats_matrix(), repeat)
+    results['get_stats_matrix'] = timing
+    with sqlite3.connect(pbx.DB_FILE) as conn:
+        conn.execute('DELETE FROM stats_periods')
+        conn.execute('DELETE FROM period_caller_stats')
+    timing, _ = measure(pbx.get_comprehensive_stats_weekly, 1)
+    results['get_comprehensive_stats_weekly_cold'] = timing
+    timing, (weekly_stats, weekly_periods) = measure(pbx.get_comprehensive_stats_weekly, repeat)
+    results['get_comprehensive_stats_weekly'] = timing
+
+    # Рендеринг шаблонов с уже подготовленными данными
+    stats_dates = pbx.get_all_stats_dates()
+    for stat in stats_dates:
+        stat['date_display'] = stat['date']
+        stat['period_label'] = pbx.format_period_label(stat['start_stamp'], stat['end_stamp'])
+    with pbx.app.test_request_context('/'):
+        timing, _ = measure(lambda: render_template(
+            'index.html', calls_period={'from': start_of_today, 'to': now}, caller_stats=today_stats,
+            error=None, title='bench', period_label=''), repeat)
+        results['render_index'] = timing
+        timing, _ = measure(lambda: render_template(
+            'stats.html', stats_dates=stats_dates, comprehensive_stats=weekly_stats,
+            weekly_periods=weekly_periods, mode='weekly'), repeat)
+        results['render_stats_weekly'] = timing
+        timing, _ = measure(lambda: render_template(
+            'stats.html', stats_dates=stats_dates, matrix_columns=pbx.STATS_MATRIX_COLUMNS, mode='daily'), repeat)
+        results['render_stats_daily'] = timing
+
+    results['db_size_bytes'] = os.path.getsize(pbx.DB_FILE)
+    results['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put(results)
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for cache, aggregation and render paths')
+    parser.add_argument('--sizes', default=','.join(DATASETS), help=f"через запятую из {', '.join(DATASETS)}")
+    parser.add_argument('--repeat', type=int, default=5, help='прогонов на каждый замер чтения')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args(argv)
+
+    sizes = [size.strip().lower() for size in args.sizes.split(',') if size.strip()]
+    unknown = [size for size in sizes if size not in DATASETS]
+    if unknown:
+        parser.error(f"unknown sizes: {', '.join(unknown)}")
+
+    report = {
+        'meta': {
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'git_commit': get_git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'seed': args.seed,
+        },
+        'results': {},
+    }
+
+    context = multiprocessing.get_context('spawn')
+    for size in sizes:
+        queue = context.Queue()
+        process = context.Process(target=run_dataset, args=(size, args.repeat, args.seed, queue))
+        started = time.perf_counter()
+        process.start()
+        while True:
+            try:
+                results = queue.get(timeout=1)
+                break
+            except Empty:
+                if not process.is_alive():
+                    raise SystemExit(f'Benchmark for {size} failed (exit code {process.exitcode})')
+        process.join()
+        results['total_seconds'] = round(time.perf_counter() - started, 3)
+        report['results'][size] = results
+
+        print(f'== {size} ({DATASETS[size][0]} calls, {results["total_seconds"]}s)')
+        for name, value in results.items():
+            if isinstance(value, dict):
+                print(f"  {name:40} median {value['median'] * 1000:10.2f} ms")
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -3,5 +3,45 @@ import os
 # Читаем из переменных окружения или используем значения по умолчанию
 DOMAIN = os.getenv('DOMAIN', 'guitardo.onpbx.ru')
 AUTH_KEY = os.getenv('AUTH_KEY', 'qJqxwdH7ZccfzS1F3UoStTRJSZHvfWTR5Dt4kiv7Og')
-API_URL = f'https://api2.onlinepbx.ru/{DOMAIN}/mongo_history/search.json'
-AUTH_URL = f'https://api2.onlinepbx.ru/{DOMAIN}/auth.json' 
\ No newline at end of file
+API_BASE_URL = os.getenv('API_BASE_URL', 'https://api2.onlinepbx.ru').rstrip('/')
+API_URL = f'{API_BASE_URL}/{DOMAIN}/mongo_history/search.json'
+AUTH_URL = f'{API_BASE_URL}/{DOMAIN}/auth.json'
+TRUNKS_URL = f'{API_BASE_URL}/{DOMAIN}/trunks/get.json'
+
+# HTTP-клиент к API: размер пула keep-alive соединений и таймауты (подключение, чтение) по эндпоинтам
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))
+API_CONNECT_TIMEOUT = float(os.getenv('API_CONNECT_TIMEOUT', '5'))
+API_TIMEOUT_AUTH = float(os.getenv('API_TIMEOUT_AUTH', '10'))
+API_TIMEOUT_SEARCH = float(os.getenv('API_TIMEOUT_SEARCH', '30'))
+API_TIMEOUT_TRUNKS = float(os.getenv('API_TIMEOUT_TRUNKS', '10'))
+# Сколько секунд от текущего момента не считаем окончательно закешированными:
+# звонки, которые ещё идут, появляются в истории API только после завершения
+CACHE_SETTLE_SECONDS = int(os.getenv('CACHE_SETTLE_SECONDS', '900'))
+
+# Фоновая загрузка звонков из API в локальную БД
+INGEST_ENABLED = os.getenv('INGEST_ENABLED', '1') == '1'
+INGEST_INTERVAL = int(os.getenv('INGEST_INTERVAL', '30'))
+# Если фоновый загрузчик молчит дольше этого времени, маршруты снова ходят в API сами
+INGEST_STALE_SECONDS = int(os.getenv('INGEST_STALE_SECONDS', str(INGEST_INTERVAL * 4)))
+
+# Максимум записей, который API отдаёт за один запрос: ответ такого размера считаем обрезанным
+API_MAX_RESULTS = int(os.getenv('API_MAX_RESULTS', '5000'))
+
+# Сколько ждать чужую загрузку того же периода (и срок аренды на загрузку), секунд
+SINGLE_FLIGHT_TIMEOUT = int(os.getenv('SINGLE_FLIGHT_TIMEOUT', '120'))
+
+# Настройки SQLite для соединений воркеров
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', '30'))
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', str(64 * 1024)))
+
+# Живая лента /today (SSE): как часто проверять новые звонки и сколько держать одно соединение, секунд
+LIVE_POLL_INTERVAL = float(os.getenv('LIVE_POLL_INTERVAL', '5'))
+LIVE_STREAM_SECONDS = int(os.getenv('LIVE_STREAM_SECONDS', '300'))
+# Сколько потоков живой ленты держит один воркер (каждый занимает поток gunicorn из threads).
+# Это верхняя граница: у gthread-воркера не больше четверти его потоков, у sync-воркера - ни одного.
+# Остальные вкладки получают 503 и опрашивают /api/live/poll
+LIVE_MAX_STREAMS = int(os.getenv('LIVE_MAX_STREAMS', '2'))
+
+# Подробная диагностика файла БД и рабочего каталога при старте (права, содержимое каталога)
+DB_DIAGNOSTICS = os.getenv('DB_DIAGNOSTICS', '0') == '1'
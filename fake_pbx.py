@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Локальная замена API onlinepbx для разработки и замеров без api2.onlinepbx.ru.
+
+Реализует auth.json, mongo_history/search.json и trunks/get.json, отдаёт синтетические
+звонки в том же виде, что и calls_history.json, и умеет имитировать задержки, isNotAuth,
+403, зависания и большие ответы.
+
+Запуск:
+    python fake_pbx.py --port 8081 --latency 0.2 --not-auth-rate 0.05
+    API_BASE_URL=http://127.0.0.1:8081 python app.py
+
+Настройки можно менять на лету: POST /_fake/config с JSON, счётчики запросов - GET /_fake/stats.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+import uuid
+
+from flask import Flask, Response, jsonify, request
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+
+# Значения по умолчанию; каждое можно задать переменной окружения FAKE_PBX_<ИМЯ>
+DEFAULT_SETTINGS = {
+    'seed': 1,                  # зерно генератора: одинаковые запросы дают одинаковые звонки
+    'calls_per_hour': 300.0,    # плотность звонков
+    'outbound_share': 0.85,     # доля исходящих среди звонков
+    'trunks': 12,               # сколько номеров (trunk'ов) у АТС
+    'events_per_call': 0,       # дополнительные события в каждом звонке - для больших ответов
+    'max_results': 5000,        # сколько записей API отдаёт максимум (дальше ответ обрезается)
+    'latency': 0.0,             # задержка перед ответом, секунд
+    'jitter': 0.0,              # случайная добавка к задержке, секунд
+    'key_ttl': 0,               # срок жизни выданного ключа, секунд (0 - бессрочно)
+    'not_auth_rate': 0.0,       # доля ответов {"isNotAuth": true}
+    'forbidden_rate': 0.0,      # доля ответов 403
+    'timeout_rate': 0.0,        # доля запросов, которые зависают на hang_seconds
+    'hang_seconds': 60.0,
+}
+
+HANGUP_CAUSES = [
+    ('NORMAL_CLEARING', 0.92), ('USER_BUSY', 0.02), ('RECOVERY_ON_TIMER_EXPIRE', 0.015),
+    ('NO_USER_RESPONSE', 0.011), ('CALL_REJECTED', 0.006), ('UNALLOCATED_NUMBER', 0.005),
+    ('ORIGINATOR_CANCEL', 0.023),
+]
+DOMAIN_HOST = os.getenv('DOMAIN', 'guitardo.onpbx.ru')
+
+app = Flask(__name__)
+
+settings = {}
+_keys = {}
+_stats = {}
+_state_lock = threading.Lock()
+
+def load_settings():
+    """Настройки по умолчанию с учётом переменных окружения"""
+    values = {}
+    for name, default in DEFAULT_SETTINGS.items():
+        raw = os.getenv(f'FAKE_PBX_{name.upper()}')
+        values[name] = type(default)(raw) if raw is not None else default
+    return values
+
+def update_settings(values):
+    """Применяет новые значения настроек, приводя их к типам по умолчанию"""
+    with _state_lock:
+        for name, value in values.items():
+            if name not in DEFAULT_SETTINGS:
+                raise KeyError(name)
+            settings[name] = type(DEFAULT_SETTINGS[name])(value)
+
+def count(name):
+    with _state_lock:
+        _stats[name] = _stats.get(name, 0) + 1
+
+def get_trunks():
+    """Номера АТС: детерминированные по seed, описания с пометками КЦ/ОП, как в рабочей АТС"""
+    rng = random.Random(f"{settings['seed']}:trunks")
+    trunks = []
+    for i in range(settings['trunks']):
+        number = f"7{rng.choice(['495', '499', '958', '901', '926'])}{rng.randrange(10 ** 7):07d}"
+        department = 'КЦ' if i % 3 else 'ОП'
+        trunks.append({
+            'number': number,
+            'description': f'{department}_Линия_{i + 1}',
+            'status': rng.choice(['registered', 'registered', 'registered', 'unregistered']),
+            'type': 'sip',
+        })
+    return trunks
+
+def make_call(index, interval, trunks):
+    """Звонок с порядковым номером index; одинаковый при каждом запросе с теми же настройками"""
+    rng = random.Random(f"{settings['seed']}:{index}")
+    start_stamp = int(index * interval)
+    call_uuid = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+    trunk = rng.choice(trunks)['number'] if trunks else ''
+    user = str(rng.randrange(700, 720))
+    destination = f'+79{rng.randrange(10 ** 9):09d}'
+    outbound = rng.random() < settings['outbound_share']
+
+    causes, weights = zip(*HANGUP_CAUSES)
+    hangup_cause = rng.choices(causes, weights)[0]
+    answered = hangup_cause == 'NORMAL_CLEARING'
+    ring = rng.randint(3, 25)
+    talk = min(int(rng.expovariate(1 / 60)), 3600) if answered else 0
+    duration = ring + talk
+    end_stamp = start_stamp + duration
+
+    user_event = {'type': 'user', 'timestamp': start_stamp, 'uuid': call_uuid, 'number': user}
+    if answered:
+        user_event['answered_stamp'] = start_stamp + ring
+    user_event['end_stamp'] = end_stamp
+    events = [{'type': 'transfer', 'timestamp': start_stamp, 'number': destination}, user_event]
+    for i in range(settings['events_per_call']):
+        events.append({'type': 'dtmf', 'timestamp': start_stamp + min(i, duration), 'digit': str(rng.randrange(10))})
+
+    return {
+        'uuid': call_uuid,
+        'caller_id_name': user,
+        'caller_id_number': trunk if outbound else destination,
+        'destination_number': destination if outbound else user,
+        'from_host': DOMAIN_HOST,
+        'to_host': DOMAIN_HOST,
+        'start_stamp': start_stamp,
+        'end_stamp': end_stamp,
+        'duration': duration,
+        'user_talk_time': talk,
+        'hangup_cause': hangup_cause,
+        'accountcode': 'outbound' if outbound else 'inbound',
+        'gateway': trunk if outbound else '',
+        'quality_score': 0,
+        'events': events,
+    }
+
+def iter_calls(start_stamp_from, start_stamp_to):
+    """Звонки с началом в [from, to], не больше max_results - как у настоящего API"""
+    interval = 3600 / settings['calls_per_hour']
+    trunks = get_trunks()
+    first = math.ceil(start_stamp_from / interval)
+    last = math.floor(start_stamp_to / interval)
+    for index in range(first, min(last + 1, first + settings['max_results'])):
+        call = make_call(index, interval, trunks)
+        if start_stamp_from <= call['start_stamp'] <= start_stamp_to:
+            yield call
+
+def iter_json_response(calls, batch_size=200):
+    """Тело {"status": "1", "data": [...]} кусками, без сборки всего ответа в памяти"""
+    yield '{"status": "1", "data": ['
+    first = True
+    batch = []
+    for call in calls:
+        batch.append(json.dumps(call, ensure_ascii=False))
+        if len(batch) >= batch_size:
+            yield ('' if first else ',') + ','.join(batch)
+            first = False
+            batch = []
+    if batch:
+        yield ('' if first else ',') + ','.join(batch)
+    yield ']}'
+
+def inject_faults(endpoint):
+    """Задержка и сбои по настройкам. Возвращает готовый ответ-сбой или None"""
+    delay = settings['latency'] + random.random() * settings['jitter']
+    if delay:
+        time.sleep(delay)
+
+    roll = random.random()
+    if roll < settings['timeout_rate']:
+        count(f'{endpoint}:timeout')
+        time.sleep(settings['hang_seconds'])
+        return None
+    roll -= settings['timeout_rate']
+    if roll < settings['forbidden_rate']:
+        count(f'{endpoint}:forbidden')
+        return jsonify({'status': '0', 'comment': 'Forbidden'}), 403
+    if endpoint != 'auth':
+        roll -= settings['forbidden_rate']
+        if roll < settings['not_auth_rate'] or not is_key_valid(request.headers.get('x-pbx-authentication', '')):
+            count(f'{endpoint}:not_auth')
+            return jsonify({'status': '0', 'isNotAuth': True})
+    return None
+
+def is_key_valid(api_key):
+    with _state_lock:
+        expires_at = _keys.get(api_key)
+    return expires_at is not None and (expires_at == 0 or expires_at > time.time())
+
+@app.route('/<domain>/auth.json', methods=['POST'])
+def auth(domain):
+    count('auth')
+    fault = inject_faults('auth')
+    if fault is not None:
+        return fault
+
+    key_id = uuid.uuid4().hex[:8]
+    key = uuid.uuid4().hex
+    expires_at = time.time() + settings['key_ttl'] if settings['key_ttl'] else 0
+    with _state_lock:
+        _keys[f'{key_id}:{key}'] = expires_at
+    return jsonify({'status': '1', 'data': {'key_id': key_id, 'key': key}})
+
+@app.route('/<domain>/mongo_history/search.json', methods=['POST'])
+def search(domain):
+    count('search')
+    fault = inject_faults('search')
+    if fault is not None:
+        return fault
+
+    try:
+        start_stamp_from = int(request.form['start_stamp_from'])
+        start_stamp_to = int(request.form.get('start_stamp_to', time.time()))
+    except (KeyError, ValueError):
+        return jsonify({'status': '0', 'comment': 'start_stamp_from is required'})
+    # Звонки "из будущего" не отдаём, как и настоящая история
+    start_stamp_to = min(start_stamp_to, int(time.time()))
+    return Response(iter_json_response(iter_calls(start_stamp_from, start_stamp_to)), mimetype='application/json')
+
+@app.route('/<domain>/trunks/get.json', methods=['POST'])
+def trunks(domain):
+    count('trunks')
+    fault = inject_faults('trunks')
+    if fault is not None:
+        return fault
+    return jsonify({'status': '1', 'data': get_trunks()})
+
+@app.route('/_fake/config', methods=['GET', 'POST'])
+def fake_config():
+    """Текущие настройки; POST с JSON меняет их без перезапуска"""
+    if request.method == 'POST':
+        try:
+            update_settings(request.get_json(force=True) or {})
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': f'Неверная настройка: {e}'}), 400
+    return jsonify(settings)
+
+@app.route('/_fake/stats', methods=['GET', 'DELETE'])
+def fake_stats():
+    """Счётчики запросов и сбоев по эндпоинтам; DELETE обнуляет их"""
+    with _state_lock:
+        if request.method == 'DELETE':
+            _stats.clear()
+        return jsonify(dict(_stats))
+
+settings.update(load_settings())
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local onlinepbx API stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    for name, default in DEFAULT_SETTINGS.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", dest=name, type=type(default), default=settings[name])
+    args = parser.parse_args(argv)
+
+    update_settings({name: getattr(args, name) for name in DEFAULT_SETTINGS})
+    logging.info(f'Fake PBX API on http://{args.host}:{args.port} with settings {settings}')
+    app.run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
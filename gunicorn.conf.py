@@ -3,6 +3,17 @@
 # Количество воркеров (обычно 2 * CPU cores + 1)
 workers = 3
 
+# Потоки в каждом воркере: живая лента /today (SSE) держит соединение открытым,
+# поэтому одновременных потоков ленты на воркер не больше LIVE_MAX_STREAMS (config.py),
+# остальные вкладки переходят на опрос
+worker_class = "gthread"
+threads = 8
+
+def post_fork(server, worker):
+    # Приложение считает по числу потоков, сколько из них можно отдать живой ленте
+    import os
+    os.environ['GUNICORN_THREADS'] = str(worker.cfg.threads)
+
 # Биндинг (порт и хост)
 bind = "0.0.0.0:8000"
 
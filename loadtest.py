@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный прогон: приложение под gunicorn (gunicorn.conf.py) против локальной замены API
+(fake_pbx.py) и смесь запросов от параллельных клиентов. По каждому маршруту считает
+p50/p95/p99 и пропускную способность, результат пишет в JSON.
+
+    python loadtest.py --clients 20 --duration 60
+    python loadtest.py --workers 5 --worker-class sync --output sync5.json
+
+БД и файл ключа создаются во временном каталоге, рабочая БД не затрагивается.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import requests
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Маршрут -> вес в смеси по умолчанию
+DEFAULT_MIX = 'today=4,1h=4,stats=1,stats_date=2,date=2'
+
+def parse_mix(value):
+    """'today=4,1h=4' -> {'today': 4, '1h': 4}"""
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = int(weight or 1)
+    unknown = set(mix) - {'today', '1h', 'stats', 'stats_date', 'date'}
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown routes in mix: {', '.join(sorted(unknown))}")
+    return mix
+
+def make_path(route, history_days, rng):
+    """Конкретный URL для маршрута; даты выбираются из последних history_days дней"""
+    if route == 'today':
+        return '/today'
+    if route == '1h':
+        return '/1h'
+    if route == 'stats':
+        return '/stats'
+    day = datetime.now().date() - timedelta(days=rng.randint(1, history_days))
+    if route == 'stats_date':
+        return f'/stats/{day.isoformat()}'
+    return f'/date/{day.isoformat()}'
+
+def wait_for_port(port, process, timeout=30):
+    """Ждёт, пока процесс начнёт принимать соединения на порту"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{process.args[:3]} exited with code {process.returncode}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'port {port} did not open within {timeout}s')
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по ближайшему рангу"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def run_clients(base_url, mix, clients, duration, history_days, seed):
+    """Гоняет смесь запросов из clients потоков duration секунд. Возвращает замеры по маршрутам"""
+    routes, weights = zip(*mix.items())
+    samples = {route: [] for route in routes}
+    statuses = {route: {} for route in routes}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(number):
+        rng = random.Random(f'{seed}:{number}')
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            route = rng.choices(routes, weights)[0]
+            path = make_path(route, history_days, rng)
+            started = time.perf_counter()
+            try:
+                response = session.get(base_url + path, timeout=120)
+                status = str(response.status_code)
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - started
+            with lock:
+                samples[route].append(elapsed)
+                statuses[route][status] = statuses[route].get(status, 0) + 1
+
+    threads = [threading.Thread(target=client, args=(number,), daemon=True) for number in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, statuses, time.perf_counter() - started
+
+def summarize(samples, statuses, elapsed):
+    """Перцентили (мс) и пропускная способность по маршрутам и в целом"""
+    report = {}
+    all_samples = []
+    for route, values in samples.items():
+        values = sorted(values)
+        all_samples.extend(values)
+        errors = sum(count for status, count in statuses[route].items() if not status.startswith(('2', '3')))
+        report[route] = {
+            'requests': len(values),
+            'errors': errors,
+            'statuses': statuses[route],
+            'rps': round(len(values) / elapsed, 2),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 2) if values else None,
+            'p95_ms': round(percentile(values, 0.95) * 1000, 2) if values else None,
+            'p99_ms': round(percentile(values, 0.99) * 1000, 2) if values else None,
+            'max_ms': round(values[-1] * 1000, 2) if values else None,
+        }
+    all_samples.sort()
+    report['total'] = {
+        'requests': len(all_samples),
+        'errors': sum(route['errors'] for route in report.values()),
+        'rps': round(len(all_samples) / elapsed, 2),
+        'p50_ms': round(percentile(all_samples, 0.50) * 1000, 2) if all_samples else None,
+        'p95_ms': round(percentile(all_samples, 0.95) * 1000, 2) if all_samples else None,
+        'p99_ms': round(percentile(all_samples, 0.99) * 1000, 2) if all_samples else None,
+    }
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test of the app under gunicorn against fake_pbx')
+    parser.add_argument('--clients', type=int, default=20, help='параллельных клиентов')
+    parser.add_argument('--duration', type=float, default=30, help='длительность замера, секунд')
+    parser.add_argument('--warmup', type=float, default=5, help='прогрев без записи результатов, секунд')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f'веса маршрутов, по умолчанию {DEFAULT_MIX}')
+    parser.add_argument('--history-days', type=int, default=7, help='из скольких прошлых дней выбирать /date и /stats/<date>')
+    parser.add_argument('--workers', type=int, help='переопределить workers из gunicorn.conf.py')
+    parser.add_argument('--worker-class', help='переопределить worker_class из gunicorn.conf.py')
+    parser.add_argument('--threads', type=int, help='переопределить threads из gunicorn.conf.py')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--upstream-port', type=int, default=8181)
+    parser.add_argument('--upstream-latency', type=float, default=0.1, help='задержка ответов fake_pbx, секунд')
+    parser.add_argument('--calls-per-hour', type=float, default=300, help='плотность звонков в fake_pbx')
+    parser.add_argument('--ingest', action='store_true', help='включить фоновую загрузку (INGEST_ENABLED=1)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='loadtest_results.json')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='pbx-loadtest-')
+    env = dict(os.environ,
+               API_BASE_URL=f'http://127.0.0.1:{args.upstream_port}',
+               INGEST_ENABLED='1' if args.ingest else '0',
+               FAKE_PBX_SEED=str(args.seed),
+               FAKE_PBX_LATENCY=str(args.upstream_latency),
+               FAKE_PBX_CALLS_PER_HOUR=str(args.calls_per_hour))
+
+    gunicorn_cmd = [sys.executable, '-m', 'gunicorn', '--config', os.path.join(PROJECT_DIR, 'gunicorn.conf.py'),
+                    '--chdir', workdir, '--pythonpath', PROJECT_DIR,
+                    '--bind', f'127.0.0.1:{args.port}', '--access-logfile', '/dev/null']
+    if args.workers:
+        gunicorn_cmd += ['--workers', str(args.workers)]
+    if args.worker_class:
+        gunicorn_cmd += ['--worker-class', args.worker_class]
+    if args.threads:
+        gunicorn_cmd += ['--threads', str(args.threads)]
+    gunicorn_cmd.append('wsgi:app')
+
+    processes = []
+    server_log = open(os.path.join(workdir, 'gunicorn.log'), 'w')
+    try:
+        upstream = subprocess.Popen([sys.executable, os.path.join(PROJECT_DIR, 'fake_pbx.py'), '--port', str(args.upstream_port)],
+                                    cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes.append(upstream)
+        wait_for_port(args.upstream_port, upstream)
+
+        server = subprocess.Popen(gunicorn_cmd, cwd=workdir, env=env, stdout=server_log, stderr=subprocess.STDOUT)
+        processes.append(server)
+        wait_for_port(args.port, server, timeout=60)
+
+        base_url = f'http://127.0.0.1:{args.port}'
+        if args.warmup:
+            print(f'Warming up for {args.warmup}s...')
+            run_clients(base_url, args.mix, args.clients, args.warmup, args.history_days, args.seed + 1)
+
+        print(f'Running {args.clients} clients for {args.duration}s...')
+        samples, statuses, elapsed = run_clients(base_url, args.mix, args.clients, args.duration, args.history_days, args.seed)
+        upstream_stats = requests.get(f'http://127.0.0.1:{args.upstream_port}/_fake/stats', timeout=5).json()
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        server_log.close()
+
+    report = {
+        'meta': {
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'clients': args.clients,
+            'duration': args.duration,
+            'mix': args.mix,
+            'gunicorn': {'workers': args.workers, 'worker_class': args.worker_class, 'threads': args.threads,
+                         'config': 'gunicorn.conf.py'},
+            'upstream_latency': args.upstream_latency,
+            'calls_per_hour': args.calls_per_hour,
+            'ingest': args.ingest,
+            'upstream_requests': upstream_stats,
+        },
+        'routes': summarize(samples, statuses, elapsed),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'route':12} {'requests':>9} {'errors':>7} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for route, stats in report['routes'].items():
+        print(f"{route:12} {stats['requests']:9} {stats['errors']:7} {stats['rps']:8} "
+              f"{stats['p50_ms'] or 0:9} {stats['p95_ms'] or 0:9} {stats['p99_ms'] or 0:9}")
+    print(f'Results written to {args.output}')
+
+if __name__ == '__main__':
+    main()
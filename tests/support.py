@@ -0,0 +1,46 @@
+"""Общая подготовка тестов: app.py импортируется один раз с БД во временном каталоге"""
+
+import os
+import sys
+import tempfile
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.py при импорте создаёт БД в текущем каталоге - уводим её во временный
+os.environ.setdefault('INGEST_ENABLED', '0')
+os.chdir(tempfile.mkdtemp(prefix='pbx-tests-'))
+sys.path.insert(0, PROJECT_DIR)
+
+import app  # noqa: E402
+
+# Таблицы с данными; схема (и user_version) при очистке не трогаются
+DATA_TABLES = ('calls', 'hourly_caller_stats', 'covered_intervals', 'daily_stats', 'trunks',
+               'stats_periods', 'period_caller_stats', 'data_versions', 'ingest_state', 'leases')
+
+
+def reset_db():
+    """Пустая БД и пустые кеши в памяти перед каждым тестом"""
+    conn = app.get_db()
+    for table in DATA_TABLES:
+        conn.execute(f'DELETE FROM {table}')
+    conn.commit()
+    with app._day_responses_lock:
+        app._day_responses.clear()
+    with app._inflight_lock:
+        app._inflight.clear()
+
+
+def make_call(call_id, start_stamp, billsec=60, number='74950000001', accountcode='outbound'):
+    """Звонок в том виде, в котором его сохраняет normalize_call"""
+    return {
+        'uuid': call_id,
+        'start_stamp': start_stamp,
+        'end_stamp': start_stamp + billsec,
+        'caller_id_number': number,
+        'destination_number': '+79000000000',
+        'billsec': billsec,
+        'duration': billsec,
+        'accountcode': accountcode,
+        'gateway': number,
+        'description': '',
+    }
@@ -0,0 +1,97 @@
+"""Статистика по номерам из почасовых агрегатов совпадает с подсчётом по сырым звонкам"""
+
+import random
+import unittest
+from datetime import datetime
+
+from support import app, make_call, reset_db
+
+NUMBERS = ['74950000001', '74950000002', '74990000003', '123']
+
+
+def brute_force_stats(start_stamp, end_stamp):
+    """Подсчёт напрямую по таблице calls, как до появления почасовых агрегатов"""
+    cursor = app.get_db().execute('''
+        SELECT caller_id_number, billsec FROM calls
+        WHERE accountcode = 'outbound' AND start_stamp >= ? AND start_stamp <= ?
+        AND length(caller_id_number) > 3
+    ''', (start_stamp, end_stamp))
+    stats = {}
+    for number, billsec in cursor.fetchall():
+        total, over = stats.get(number, (0, 0))
+        stats[number] = (total + 1, over + (billsec > app.LONG_CALL_SECONDS))
+    return stats
+
+
+def rollup_stats(start_stamp, end_stamp):
+    return {stat['caller_number']: (stat['total_calls'], stat['calls_over_45s'])
+            for stat in app.get_caller_stats(start_stamp, end_stamp)}
+
+
+class CallerStatsTest(unittest.TestCase):
+    def setUp(self):
+        reset_db()
+        self.rng = random.Random(14)
+        self.base = 1758488400  # начало часа
+        calls = [
+            make_call(f'call-{i}', self.base + self.rng.randrange(2 * 86400),
+                      billsec=self.rng.choice([0, 10, 45, 46, 120]),
+                      number=self.rng.choice(NUMBERS),
+                      accountcode=self.rng.choice(['outbound', 'outbound', 'inbound']))
+            for i in range(3000)
+        ]
+        app.save_calls_to_cache(calls, 0, 0, mark_covered=False)
+
+    def assert_matches_brute_force(self, windows):
+        for start_stamp, end_stamp in windows:
+            with self.subTest(start=start_stamp - self.base, end=end_stamp - self.base):
+                self.assertEqual(rollup_stats(start_stamp, end_stamp), brute_force_stats(start_stamp, end_stamp))
+
+    def test_random_windows(self):
+        windows = []
+        for _ in range(200):
+            start_stamp = self.base - 3600 + self.rng.randrange(2 * 86400 + 7200)
+            windows.append((start_stamp, start_stamp + self.rng.randrange(3 * 86400)))
+        self.assert_matches_brute_force(windows)
+
+    def test_edge_hours(self):
+        hour = self.base + 5 * 3600
+        self.assert_matches_brute_force([
+            (hour, hour + 3599),           # ровно один час
+            (hour, hour + 3600),           # час и секунда следующего
+            (hour + 1, hour + 3599),       # час без первой секунды
+            (hour + 1800, hour + 5399),    # без единого целого часа
+            (hour + 1800, hour + 9000),    # неполные часы с обеих сторон
+            (hour + 10, hour + 20),
+            (hour, hour),
+        ])
+
+    def test_resaved_call_moved_to_another_hour(self):
+        reset_db()
+        call = make_call('moved', self.base + 600, billsec=120)
+        app.save_calls_to_cache([dict(call)], 0, 0, mark_covered=False)
+        app.save_calls_to_cache([dict(call, start_stamp=call['start_stamp'] + 2 * 3600)], 0, 0, mark_covered=False)
+
+        day = (self.base, self.base + 86399)
+        self.assertEqual(rollup_stats(*day), {call['caller_id_number']: (1, 1)})
+        self.assert_matches_brute_force([day, (self.base, self.base + 3599), (self.base + 7200, self.base + 10799)])
+
+    def test_resaved_call_moved_to_another_day_bumps_both_days(self):
+        reset_db()
+        midnight = int(datetime(2025, 9, 23).timestamp())
+        call = make_call('moved', midnight - 600)
+        old_day = datetime.fromtimestamp(call['start_stamp']).strftime('%Y-%m-%d')
+        new_stamp = call['start_stamp'] + 3600
+        new_day = datetime.fromtimestamp(new_stamp).strftime('%Y-%m-%d')
+        self.assertNotEqual(old_day, new_day)
+
+        app.save_calls_to_cache([dict(call)], 0, 0, mark_covered=False)
+        versions = app.get_data_versions(old_day, new_day)
+        app.save_calls_to_cache([dict(call, start_stamp=new_stamp)], 0, 0, mark_covered=False)
+
+        self.assertEqual(app.get_data_versions(old_day, new_day), [versions[0] + 1, versions[1] + 1])
+        self.assertEqual(rollup_stats(call['start_stamp'] - 86400, new_stamp + 86400), {call['caller_id_number']: (1, 1)})
+
+
+if __name__ == '__main__':
+    unittest.main()
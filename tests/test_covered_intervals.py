@@ -0,0 +1,127 @@
+"""Индекс покрытых кешем интервалов: объединение, поиск пропусков, свежий хвост и перенос cache_requests"""
+
+import time
+import unittest
+
+from support import app, reset_db
+
+
+def covered_intervals():
+    cursor = app.get_db().execute('SELECT start_stamp, end_stamp FROM covered_intervals ORDER BY start_stamp')
+    return cursor.fetchall()
+
+
+def mark(*periods):
+    conn = app.get_db()
+    cursor = conn.cursor()
+    for start_stamp, end_stamp in periods:
+        app.mark_period_covered(cursor, start_stamp, end_stamp)
+    conn.commit()
+
+
+class MarkPeriodCoveredTest(unittest.TestCase):
+    def setUp(self):
+        reset_db()
+
+    def test_adjacent_intervals_merge(self):
+        mark((100, 199), (200, 299))
+        self.assertEqual(covered_intervals(), [(100, 299)])
+
+    def test_overlapping_and_contained_intervals_merge(self):
+        mark((100, 300), (250, 400), (150, 200))
+        self.assertEqual(covered_intervals(), [(100, 400)])
+
+    def test_interval_bridging_two_others(self):
+        mark((100, 199), (300, 399))
+        self.assertEqual(covered_intervals(), [(100, 199), (300, 399)])
+        mark((150, 350))
+        self.assertEqual(covered_intervals(), [(100, 399)])
+
+    def test_separate_intervals_stay_separate(self):
+        mark((100, 199), (201, 300))
+        self.assertEqual(covered_intervals(), [(100, 199), (201, 300)])
+
+
+class UncoveredGapsTest(unittest.TestCase):
+    def setUp(self):
+        reset_db()
+
+    def test_empty_cache(self):
+        self.assertEqual(app.get_uncovered_gaps(100, 200), [(100, 200)])
+
+    def test_gaps_between_and_around_intervals(self):
+        mark((100, 199), (300, 399))
+        self.assertEqual(app.get_uncovered_gaps(50, 450), [(50, 99), (200, 299), (400, 450)])
+        self.assertEqual(app.get_uncovered_gaps(120, 180), [])
+        self.assertEqual(app.get_uncovered_gaps(150, 350), [(200, 299)])
+        self.assertTrue(app.is_period_cached(300, 399))
+        self.assertFalse(app.is_period_cached(300, 400))
+
+    def test_fresh_tail_is_not_covered(self):
+        now = int(time.time())
+        settled_before = now - app.CACHE_SETTLE_SECONDS
+        start_stamp = settled_before - 3600
+        conn = app.get_db()
+        app.cover_period(conn.cursor(), start_stamp, now)
+        conn.commit()
+
+        # Граница может сдвинуться на секунду, пока выполнялся тест
+        (covered_start, covered_end), = covered_intervals()
+        self.assertEqual(covered_start, start_stamp)
+        self.assertIn(covered_end, (settled_before, settled_before + 1))
+        self.assertEqual(app.get_uncovered_gaps(start_stamp, now), [(covered_end + 1, now)])
+
+    def test_period_inside_settle_window_is_not_covered(self):
+        now = int(time.time())
+        conn = app.get_db()
+        app.cover_period(conn.cursor(), now - 60, now)
+        conn.commit()
+        self.assertEqual(covered_intervals(), [])
+
+
+class LegacyCacheRequestsTest(unittest.TestCase):
+    def setUp(self):
+        reset_db()
+
+    def tearDown(self):
+        app.get_db().execute('DROP TABLE IF EXISTS cache_requests')
+
+    def test_cache_requests_converted_to_intervals(self):
+        now = int(time.time())
+        conn = app.get_db()
+        conn.execute('''
+            CREATE TABLE cache_requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                request_hash TEXT UNIQUE,
+                start_stamp INTEGER,
+                end_stamp INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        requested_at = now - 86400
+        conn.executemany('''
+            INSERT INTO cache_requests (request_hash, start_stamp, end_stamp, created_at)
+            VALUES (?, ?, ?, datetime(?, 'unixepoch'))
+        ''', [
+            ('a', 1000, 1999, requested_at),
+            # Соседний с первым - объединяется
+            ('b', 2000, 2999, requested_at),
+            # Запрошен "на сейчас": хвост позже момента запроса минус CACHE_SETTLE_SECONDS отрезается
+            ('c', requested_at - 7200, requested_at, requested_at),
+            # Целиком в неустоявшемся хвосте - не переносится
+            ('d', requested_at - 60, requested_at, requested_at),
+        ])
+        conn.commit()
+
+        app.migrate_covered_intervals(conn.cursor())
+        conn.commit()
+
+        self.assertEqual(covered_intervals(), [
+            (1000, 2999),
+            (requested_at - 7200, requested_at - app.CACHE_SETTLE_SECONDS),
+        ])
+        self.assertFalse(app.table_exists(conn.cursor(), 'cache_requests'))
+
+
+if __name__ == '__main__':
+    unittest.main()
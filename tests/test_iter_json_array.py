@@ -0,0 +1,52 @@
+"""Потоковый разбор JSON (iter_json_array) на границах кусков"""
+
+import json
+import unittest
+
+from support import app
+
+iter_json_array = app.iter_json_array
+
+
+def split_every(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class IterJsonArrayTest(unittest.TestCase):
+    def test_top_level_numbers_split_inside_number(self):
+        cases = [
+            (['[12.', '5]'], [12.5]),
+            (['[1e', '5]'], [1e5]),
+            (['[1E', '+5]'], [1e5]),
+            (['[2.5e', '-', '3]'], [2.5e-3]),
+            (['[-', '7, 8]'], [-7, 8]),
+            (['[12', '3]'], [123]),
+            (['[1.', '5', ',2]'], [1.5, 2]),
+        ]
+        for chunks, expected in cases:
+            with self.subTest(chunks=chunks):
+                self.assertEqual(list(iter_json_array(chunks)), expected)
+
+    def test_any_chunk_size(self):
+        items = [1, 12.5, -3e-4, 'строка', True, None, {'a': [1, 2.75]}, [1e10]]
+        text = json.dumps(items, ensure_ascii=False)
+        for size in range(1, len(text) + 1):
+            with self.subTest(size=size):
+                self.assertEqual(list(iter_json_array(split_every(text, size))), items)
+
+    def test_array_in_field_with_meta(self):
+        text = '{"status": "1", "data": [{"uuid": "a", "billsec": 45}, 7.25], "total": 2}'
+        for size in range(1, len(text) + 1):
+            meta = {}
+            with self.subTest(size=size):
+                items = list(iter_json_array(split_every(text, size), key='data', meta=meta))
+                self.assertEqual(items, [{'uuid': 'a', 'billsec': 45}, 7.25])
+                self.assertEqual(meta, {'status': '1', 'total': 2})
+
+    def test_invalid_json(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array(['[1,', ' 2']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+"""Миграции схемы: БД исходной версии приложения обновляется на месте без потери данных"""
+
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from support import app
+
+# Схема БД, которую создавала исходная версия приложения (user_version = 0)
+BASELINE_SCHEMA = '''
+    CREATE TABLE calls (
+        id TEXT PRIMARY KEY,
+        start_stamp INTEGER NOT NULL,
+        end_stamp INTEGER NOT NULL,
+        caller_id_number TEXT,
+        destination_number TEXT,
+        billsec INTEGER,
+        duration INTEGER,
+        accountcode TEXT,
+        gateway TEXT,
+        caller_id_name TEXT,
+        description TEXT,
+        call_data TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX idx_start_stamp ON calls(start_stamp);
+    CREATE INDEX idx_end_stamp ON calls(end_stamp);
+    CREATE TABLE trunks (
+        number TEXT PRIMARY KEY,
+        description TEXT,
+        trunk_data TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE cache_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        request_hash TEXT UNIQUE,
+        start_stamp INTEGER,
+        end_stamp INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE daily_stats (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        date TEXT NOT NULL,
+        start_stamp INTEGER NOT NULL,
+        end_stamp INTEGER NOT NULL,
+        caller_number TEXT NOT NULL,
+        description TEXT,
+        total_calls INTEGER NOT NULL,
+        calls_over_45s INTEGER NOT NULL,
+        percentage_over_45s REAL NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(date, caller_number)
+    );
+    CREATE INDEX idx_date ON daily_stats(date);
+'''
+
+HOUR = 1758488400
+
+
+class MigrationsTest(unittest.TestCase):
+    def setUp(self):
+        self.db_file = os.path.join(tempfile.mkdtemp(prefix='pbx-migrations-'), 'calls_history.db')
+        patcher = mock.patch.object(app, 'DB_FILE', self.db_file)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file)
+        self.addCleanup(conn.close)
+        return conn
+
+    def create_baseline_db(self):
+        conn = self.connect()
+        conn.executescript(BASELINE_SCHEMA)
+        conn.executemany('''
+            INSERT INTO calls (id, start_stamp, end_stamp, caller_id_number, billsec, duration, accountcode, call_data)
+            VALUES (?, ?, ?, '74950000001', ?, ?, 'outbound', '{}')
+        ''', [(f'call-{i}', HOUR + i * 600, HOUR + i * 600 + 60, 30 + i * 10, 60) for i in range(12)])
+        conn.execute("INSERT INTO trunks (number, description) VALUES ('74950000001', 'КЦ_1')")
+        conn.execute('''
+            INSERT INTO daily_stats (date, start_stamp, end_stamp, caller_number, description,
+                                     total_calls, calls_over_45s, percentage_over_45s)
+            VALUES ('2025-09-22', ?, ?, '74950000001', 'КЦ_1', 12, 10, 83.3)
+        ''', (HOUR, HOUR + 86399))
+        requested_at = int(time.time()) - 86400
+        conn.execute('''
+            INSERT INTO cache_requests (request_hash, start_stamp, end_stamp, created_at)
+            VALUES ('hash', ?, ?, datetime(?, 'unixepoch'))
+        ''', (HOUR, HOUR + 7199, requested_at))
+        conn.commit()
+        return conn
+
+    def test_baseline_db_is_migrated_in_place(self):
+        conn = self.create_baseline_db()
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], 0)
+
+        app.init_db()
+
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], len(app.MIGRATIONS))
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM calls').fetchone()[0], 12)
+        self.assertIn('content_hash', app.table_columns(conn.cursor(), 'calls'))
+        self.assertEqual(conn.execute('SELECT caller_number, total_calls FROM daily_stats').fetchall(),
+                         [('74950000001', 12)])
+        self.assertEqual(conn.execute('SELECT number, description FROM trunks').fetchall(), [('74950000001', 'КЦ_1')])
+        # Запрошенные периоды перенесены в индекс покрытия - история не загружается заново
+        self.assertEqual(conn.execute('SELECT start_stamp, end_stamp FROM covered_intervals').fetchall(),
+                         [(HOUR, HOUR + 7199)])
+        self.assertFalse(app.table_exists(conn.cursor(), 'cache_requests'))
+        # Почасовые агрегаты построены по уже накопленным звонкам
+        self.assertEqual(conn.execute('SELECT SUM(total_calls), SUM(calls_over_45s) FROM hourly_caller_stats').fetchone(),
+                         (12, 10))
+
+    def test_second_init_is_noop(self):
+        conn = self.create_baseline_db()
+        app.init_db()
+        schema = conn.execute('SELECT type, name, sql FROM sqlite_master ORDER BY name').fetchall()
+        hourly = conn.execute('SELECT * FROM hourly_caller_stats ORDER BY hour_start').fetchall()
+
+        with self.assertLogs(level='INFO') as logs:
+            app.init_db()
+
+        self.assertFalse([line for line in logs.output if 'Applied migration' in line])
+        self.assertEqual(conn.execute('SELECT type, name, sql FROM sqlite_master ORDER BY name').fetchall(), schema)
+        self.assertEqual(conn.execute('SELECT * FROM hourly_caller_stats ORDER BY hour_start').fetchall(), hourly)
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], len(app.MIGRATIONS))
+
+    def test_oldest_calls_table_gets_missing_columns(self):
+        # Ещё более ранняя таблица calls без end_stamp и call_data раньше пересоздавалась с потерей данных
+        conn = self.connect()
+        conn.execute('''
+            CREATE TABLE calls (
+                id TEXT PRIMARY KEY,
+                start_stamp INTEGER NOT NULL,
+                caller_id_number TEXT,
+                billsec INTEGER,
+                duration INTEGER,
+                accountcode TEXT
+            )
+        ''')
+        conn.execute("INSERT INTO calls VALUES ('old', ?, '74950000001', 50, 70, 'outbound')", (HOUR,))
+        conn.commit()
+
+        app.init_db()
+
+        self.assertEqual(conn.execute('SELECT id, end_stamp, call_data FROM calls').fetchall(), [('old', HOUR + 70, None)])
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], len(app.MIGRATIONS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""Недельная и месячная статистика из материализованных агрегатов совпадает с расчётом по daily_stats"""
+
+import random
+import unittest
+from datetime import date, timedelta
+
+from support import app, reset_db
+
+
+def reference_stats(periods):
+    """Расчёт по daily_stats в лоб: все известные номера, суммы по дням каждого периода"""
+    rows = app.get_db().execute('SELECT date, caller_number, total_calls, calls_over_45s FROM daily_stats').fetchall()
+    numbers = sorted({row[1] for row in rows})
+    result = []
+    for number in numbers:
+        weeks = {}
+        for period in periods:
+            start, end = period['start'].isoformat(), period['end'].isoformat()
+            total = sum(row[2] for row in rows if row[1] == number and start <= row[0] <= end)
+            over = sum(row[3] for row in rows if row[1] == number and start <= row[0] <= end)
+            weeks[period['key']] = (total, over)
+        result.append((number, weeks))
+    result.sort(key=lambda item: item[1][periods[0]['key']][0], reverse=True)
+    return result
+
+
+def as_comparable(stats):
+    return [(stat['caller_number'], {key: (week['total_calls'], week['calls_over_45s'])
+                                     for key, week in stat['weeks'].items()})
+            for stat in stats]
+
+
+class PeriodStatsTest(unittest.TestCase):
+    def setUp(self):
+        reset_db()
+        rng = random.Random(15)
+        today = date.today()
+        rows = []
+        for offset in range(1, 60):
+            day = (today - timedelta(days=offset)).isoformat()
+            for number in ('74950000001', '74950000002', '74990000003'):
+                if rng.random() < 0.7:
+                    total = rng.randrange(1, 50)
+                    rows.append((day, number, total, rng.randrange(total + 1)))
+        # Номер, звонивший только давно - вне всех показываемых недель
+        rows.append(((today - timedelta(days=300)).isoformat(), '74951234567', 5, 1))
+        conn = app.get_db()
+        conn.executemany('''
+            INSERT INTO daily_stats (date, start_stamp, end_stamp, caller_number, description,
+                                     total_calls, calls_over_45s, percentage_over_45s)
+            VALUES (?, 0, 0, ?, 'КЦ', ?, ?, 0)
+        ''', rows)
+        conn.commit()
+
+    def test_weekly_matches_reference(self):
+        stats, periods = app.get_comprehensive_stats_weekly()
+        self.assertEqual(as_comparable(stats), reference_stats(periods))
+        self.assertIn('74951234567', [stat['caller_number'] for stat in stats])
+
+    def test_monthly_matches_reference(self):
+        stats, periods = app.get_comprehensive_stats_monthly()
+        self.assertEqual(as_comparable(stats), reference_stats(periods))
+
+    def test_materialized_periods_are_reused(self):
+        first, _ = app.get_comprehensive_stats_weekly()
+        second, periods = app.get_comprehensive_stats_weekly()
+        self.assertEqual(as_comparable(second), as_comparable(first))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+"""Одна загрузка периода на всех: потоки процесса ждут первого, чужая аренда истекает и перехватывается"""
+
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+from support import app, make_call, reset_db
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, data):
+        self.body = json.dumps(data).encode()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return json.loads(self.body)
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+
+class FakeApi:
+    """Заглушка pbx_post: считает запросы истории и отвечает одним звонком в начале периода"""
+
+    def __init__(self, delay=0.3):
+        self.delay = delay
+        self.searches = []
+        self.lock = threading.Lock()
+
+    def __call__(self, endpoint, url, data=None, **kwargs):
+        if endpoint == 'auth':
+            return FakeResponse({'status': '1', 'data': {'key_id': 'id', 'key': 'key'}})
+        with self.lock:
+            self.searches.append((data['start_stamp_from'], data['start_stamp_to']))
+        time.sleep(self.delay)
+        call = make_call('call-1', data['start_stamp_from'])
+        return FakeResponse({'status': '1', 'data': [call]})
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        reset_db()
+        self.api = FakeApi()
+        patcher = mock.patch.object(app, 'pbx_post', self.api)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Закрытый период: целиком старше CACHE_SETTLE_SECONDS
+        self.start_stamp = int(time.time()) - 3 * 86400
+        self.end_stamp = self.start_stamp + 3599
+
+    def ensure_cached(self):
+        return app.ensure_period_cached(self.start_stamp, self.end_stamp, {})
+
+    def test_concurrent_requests_fetch_once(self):
+        threads_count = 8
+        barrier = threading.Barrier(threads_count)
+        results = []
+
+        def request():
+            barrier.wait()
+            results.append(self.ensure_cached())
+
+        threads = [threading.Thread(target=request) for _ in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [None] * threads_count)
+        self.assertEqual(self.api.searches, [(self.start_stamp, self.end_stamp)])
+        self.assertTrue(app.is_period_cached(self.start_stamp, self.end_stamp))
+
+    def hold_lease(self, owner, expires_at):
+        conn = app.get_db()
+        conn.execute('INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)',
+                     (f'fetch:{self.start_stamp}:{self.end_stamp}', owner, expires_at))
+        conn.commit()
+
+    def test_expired_lease_is_taken_over(self):
+        self.hold_lease('dead-worker', int(time.time()) - 1)
+        self.assertIsNone(self.ensure_cached())
+        self.assertEqual(len(self.api.searches), 1)
+        self.assertTrue(app.is_period_cached(self.start_stamp, self.end_stamp))
+
+    def test_lease_of_failed_worker_is_taken_over_after_expiry(self):
+        # Воркер взял аренду и упал: период не покрыт, после истечения аренды грузим сами
+        self.hold_lease('crashed-worker', int(time.time()) + 1)
+        started = time.monotonic()
+        self.assertIsNone(self.ensure_cached())
+        self.assertGreaterEqual(time.monotonic() - started, 0.5)
+        self.assertEqual(len(self.api.searches), 1)
+        self.assertTrue(app.is_period_cached(self.start_stamp, self.end_stamp))
+
+    def test_lease_held_past_deadline_is_an_error(self):
+        self.hold_lease('stuck-worker', int(time.time()) + 3600)
+        with mock.patch.object(app, 'SINGLE_FLIGHT_TIMEOUT', 1):
+            error = self.ensure_cached()
+        self.assertTrue(error)
+        self.assertEqual(self.api.searches, [])
+        self.assertFalse(app.is_period_cached(self.start_stamp, self.end_stamp))
+
+
+if __name__ == '__main__':
+    unittest.main()